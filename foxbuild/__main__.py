@@ -6,6 +6,7 @@ import uvicorn
 from foxbuild.config import config
 from foxbuild.setup_sandbox_env import setup_sandbox_env
 from foxbuild.web import app
+from foxbuild.worker import worker
 
 if len(sys.argv) == 1:
     raise ValueError
@@ -13,5 +14,7 @@ if sys.argv[1] == 'setup-sandbox-env':
     asyncio.run(setup_sandbox_env())
 elif sys.argv[1] == 'server':
     uvicorn.run(app, host=config.host, port=config.port)
+elif sys.argv[1] == 'worker':
+    asyncio.run(worker.run())
 else:
     raise ValueError
@@ -0,0 +1,41 @@
+import asyncio
+import logging
+from weakref import WeakSet
+
+logger = logging.getLogger(__name__)
+
+
+class BuildTracker:
+    # Running builds by group (a branch of a repository) and the revision
+    # they build, so builds of older revisions can be cancelled once a newer
+    # one is pushed
+    _builds: dict[str, dict[asyncio.Task, str]]
+    _superseded: WeakSet[asyncio.Task]
+
+    def __init__(self):
+        self._builds = {}
+        self._superseded = WeakSet()
+
+    def track(self, group: str, revision: str, task: asyncio.Task):
+        self._builds.setdefault(group, {})[task] = revision
+
+    def untrack(self, group: str, task: asyncio.Task):
+        builds = self._builds.get(group, {})
+        builds.pop(task, None)
+        if not builds:
+            self._builds.pop(group, None)
+
+    def supersede(self, group: str, revision: str):
+        for task, task_revision in self._builds.get(group, {}).items():
+            if task_revision != revision and task not in self._superseded:
+                logger.info(f'Cancelling the build of {task_revision} in {group}')
+                self._superseded.add(task)
+                task.cancel()
+
+    def is_superseded(self, task: asyncio.Task) -> bool:
+        return task in self._superseded
+
+
+build_tracker = BuildTracker()
+
+__all__ = ['BuildTracker', 'build_tracker']
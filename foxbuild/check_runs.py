@@ -0,0 +1,171 @@
+import asyncio
+import logging
+
+from foxbuild.config import config
+from foxbuild.github import InstallationClient
+from foxbuild.schemas import RunResult, RunStatus, StageState, StageStatus
+
+logger = logging.getLogger(__name__)
+
+# GitHub rejects check run output fields longer than that
+MAX_OUTPUT_CHARS = 65535
+STAGE_EXCERPT_CHARS = 4000
+TRUNCATED_NOTE = '\n\n_Output truncated, see the full logs._'
+
+
+def get_run_url(status: RunStatus) -> str | None:
+    if not config.public_url:
+        return None
+    return f'{config.public_url.rstrip("/")}/runs/{status.provider}/{status.run_id}'
+
+
+def describe_stage(stage: StageStatus) -> str:
+    if stage.state != StageState.finished:
+        return stage.state.value
+    if stage.exit_code == 0:
+        return 'passed'
+    return f'failed ({stage.exit_code})'
+
+
+def format_summary(status: RunStatus) -> str:
+    run_url = get_run_url(status)
+    lines = ['| Workflow | Stage | State | Log |', '| --- | --- | --- | --- |']
+    for key, stage in status.stages.items():
+        log = f'[log]({run_url}/logs/{key})' if run_url else ''
+        lines.append(
+            f'| {stage.workflow} | {stage.stage} | {describe_stage(stage)} | {log} |'
+        )
+    return truncate('\n'.join(lines))
+
+
+def format_failures(status: RunStatus, result: RunResult) -> str | None:
+    sections = []
+    size = 0
+    for stage in status.stages.values():
+        if stage.state != StageState.finished or stage.exit_code == 0:
+            continue
+        workflow_result = result.workflows.get(stage.workflow)
+        stage_result = workflow_result and workflow_result.stages.get(stage.stage)
+        if stage_result is None:
+            continue
+        excerpt = (stage_result.stdout + stage_result.stderr)[-STAGE_EXCERPT_CHARS:]
+        section = f'### {stage.workflow} / {stage.stage}\n\n````\n{excerpt}\n````'
+        size += len(section) + 2
+        if size > MAX_OUTPUT_CHARS - len(TRUNCATED_NOTE):
+            sections.append(TRUNCATED_NOTE.strip())
+            break
+        sections.append(section)
+    return '\n\n'.join(sections) or None
+
+
+def truncate(text: str) -> str:
+    if len(text) <= MAX_OUTPUT_CHARS:
+        return text
+    return text[: MAX_OUTPUT_CHARS - len(TRUNCATED_NOTE)] + TRUNCATED_NOTE
+
+
+class CheckRunReporter:
+    # Publishes the progress of a run to its check run. Status changes are
+    # coalesced into at most one update per check_run_update_interval, and
+    # intermediate updates are skipped when the installation is low on its
+    # rate limit, so the final one still goes through
+    client: InstallationClient
+    url: str
+    _flush_task: asyncio.Task | None
+    _lock: asyncio.Lock
+
+    def __init__(self, client: InstallationClient, repo_name: str, check_run_id: int):
+        self.client = client
+        self.url = f'/repos/{repo_name}/check-runs/{check_run_id}'
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    async def _patch(self, data: dict):
+        # keeps updates in order
+        async with self._lock:
+            resp = await self.client.patch(self.url, json=data)
+            resp.raise_for_status()
+
+    async def start(self, status: RunStatus):
+        data = {'status': 'in_progress'}
+        if run_url := get_run_url(status):
+            data['details_url'] = run_url
+        await self._patch(data)
+
+    def update(self, status: RunStatus):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later(status))
+
+    async def _flush_later(self, status: RunStatus):
+        await asyncio.sleep(config.check_run_update_interval)
+        self._flush_task = None
+        if self.client.rate_limit.is_low:
+            return
+        done = sum(not x.is_active for x in status.stages.values())
+        try:
+            await self._patch(
+                {
+                    'status': 'in_progress',
+                    'output': {
+                        'title': f'{done} of {len(status.stages)} stages done',
+                        'summary': format_summary(status),
+                    },
+                }
+            )
+        except Exception:
+            logger.exception('Failed to update the check run')
+
+    async def discard(self):
+        if task := self._flush_task:
+            self._flush_task = None
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def complete(self, status: RunStatus, result: RunResult):
+        await self.discard()
+        failed = sum(
+            x.state == StageState.finished and x.exit_code != 0
+            for x in status.stages.values()
+        )
+        if failed:
+            title = f'{failed} of {len(status.stages)} stages failed'
+        elif result.is_ok:
+            title = 'All stages passed'
+        else:
+            title = 'Not all stages were run'
+        output = {
+            'title': title,
+            'summary': format_summary(status),
+        }
+        if text := format_failures(status, result):
+            output['text'] = text
+        await self._patch(
+            {
+                'status': 'completed',
+                'conclusion': 'success' if result.is_ok else 'failure',
+                'output': output,
+            }
+        )
+
+    async def cancel(self, summary: str):
+        await self.discard()
+        await self._patch(
+            {
+                'status': 'completed',
+                'conclusion': 'cancelled',
+                'output': {'title': 'Cancelled', 'summary': summary},
+            }
+        )
+
+    async def fail(self, title: str, summary: str):
+        await self.discard()
+        await self._patch(
+            {
+                'status': 'completed',
+                'conclusion': 'failure',
+                'output': {'title': title, 'summary': truncate(summary)},
+            }
+        )
+
+
+__all__ = ['CheckRunReporter']
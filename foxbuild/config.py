@@ -15,6 +15,24 @@ from typing import Annotated
 class OperationMode(Enum):
     local = enum.auto()
     standalone = enum.auto()
+    # runs stages for a coordinator, see Config.coordinator
+    worker = enum.auto()
+
+
+class WorkspaceMode(Enum):
+    # full local clone per stage
+    clone = 'clone'
+    # one checkout per run, stages get `cp --reflink` copies of it
+    reflink = 'reflink'
+    # one checkout per run, stages get an overlayfs mount on top of it
+    overlay = 'overlay'
+
+
+class SandboxBackend(Enum):
+    # podman CLI
+    cli = 'cli'
+    # libpod REST API over the podman socket, always uses sessions
+    api = 'api'
 
 
 class Config(BaseSettings):
@@ -29,9 +47,106 @@ class Config(BaseSettings):
     global_profile_dir: Path = None
     nix_cache_dir: Path = None
     empty_dir: Path = None
+    logs_dir: Path = None
+    result_cache_dir: Path = None
+    dir_cache_dir: Path = None
+    image_store_dir: Path = None
 
     mode: OperationMode = None
     always_use_sandbox: bool = None
+    max_parallel_stages: int = 4
+    # a stage only starts when its `resources:` reservation, or the default
+    # one, fits into the host capacity. Detected if unset, except for workers:
+    # each worker process admits stages on its own, so they must be set to
+    # the share of the host the worker may use
+    host_cpus: float | None = None
+    host_memory: int | None = None
+    stage_default_cpus: float = 1
+    stage_default_memory: int = 0
+    workspace_mode: WorkspaceMode = WorkspaceMode.clone
+    # one container per stage, commands are run with podman exec
+    sandbox_session: bool = True
+    sandbox_backend: SandboxBackend = SandboxBackend.cli
+    # idle started sandboxes kept for the default image, sandbox_pool_images
+    # and the sandbox_pool_top_images most used images. Requires root
+    sandbox_pool_size: int = 0
+    sandbox_pool_per_image: int = 2
+    sandbox_pool_images: list[str] = []
+    sandbox_pool_top_images: int = 2
+    sandbox_pool_idle_timeout: int = 10 * 60
+
+    # stage output is streamed to a log file, results only keep the first
+    # and the last bytes of each stream
+    stage_output_head: int = 8 * 1024
+    stage_output_tail: int = 32 * 1024
+
+    # successful stage results are reused for the same tree, stage definition
+    # and environment. Least recently used ones are evicted past the limits
+    result_cache_max_count: int | None = 10000
+    result_cache_max_size: int | None = 1024 * 1024 * 1024
+
+    # snapshots of `cache:` directories of stages
+    dir_cache_max_count: int | None = None
+    dir_cache_max_size: int | None = 10 * 1024 * 1024 * 1024
+
+    # run dirs are removed this long after they were last modified, oldest
+    # ones are removed earlier when they take more than runs_max_size
+    runs_retention: int = 3 * 24 * 60 * 60
+    runs_max_size: int | None = None
+    logs_retention: int = 30 * 24 * 60 * 60
+    janitor_interval: int = 30 * 60
+    janitor_batch_size: int = 32
+
+    # mount image_store_dir into sandboxes as a read-only additional image
+    # store for podman inside them. Images in `nested_images:` of stages are
+    # pulled into it and re-pulled after image_store_refresh_interval
+    nested_image_store: bool = False
+    image_store_refresh_interval: int = 6 * 60 * 60
+    image_store_prune_interval: int = 24 * 60 * 60
+    # old versions of re-pulled images are kept this long, running stages may
+    # still use them
+    image_store_replaced_retention: int = 24 * 60 * 60
+
+    # stages are run by `foxbuild worker` processes polling this server
+    # instead of by this process
+    coordinator: bool = False
+    # base url of the coordinator, for workers
+    coordinator_url: str | None = None
+    # shared secret of the coordinator and its workers
+    worker_token: str | None = None
+    worker_poll_timeout: int = 30
+    # workers serve /metrics there if set, stage metrics are only in workers
+    worker_metrics_host: str = '127.0.0.1'
+    worker_metrics_port: int | None = None
+
+    queue_workers: int = 2
+    queue_lease_seconds: int = 60
+    queue_max_attempts: int = 3
+    queue_retry_delay: int = 30
+
+    # redelivered webhooks with an already seen X-GitHub-Delivery are ignored
+    delivery_dedup_window: int = 24 * 60 * 60
+    # a newer commit on a branch cancels queued and running builds of older ones
+    supersede_stale_runs: bool = False
+
+    mirror_maintenance_interval: int = 6 * 60 * 60
+
+    # nixpkgs revision for `packages:` stages, resolved from nixpkgs-unstable
+    # and re-pinned every nixpkgs_pin_ttl seconds if unset
+    nixpkgs_rev: str | None = None
+    nixpkgs_pin_ttl: int = 7 * 24 * 60 * 60
+
+    # least recently used profiles are evicted past either limit
+    profile_store_max_count: int | None = None
+    profile_store_max_size: int | None = None
+    profile_store_check_interval: int = 10 * 60
+    # run nix store gc when /nix/store has less free bytes than that
+    nix_gc_min_free: int | None = None
+
+    # base url of this server, used to link check runs to the live logs
+    public_url: str | None = None
+    # intermediate check run updates are sent at most this often
+    check_run_update_interval: float = 10
 
     gh_app_id: int | None = None
     gh_key: (
@@ -46,6 +161,8 @@ class Config(BaseSettings):
             return v
         if len(sys.argv) > 1 and sys.argv[1] == 'server':
             return OperationMode.standalone
+        elif len(sys.argv) > 1 and sys.argv[1] == 'worker':
+            return OperationMode.worker
         else:
             return OperationMode.local
 
@@ -55,7 +172,7 @@ class Config(BaseSettings):
     def default_always_use_sandbox(cls, v: Path | None, info: ValidationInfo):
         if v is not None:
             return v
-        return info.data['mode'] == OperationMode.standalone
+        return info.data['mode'] != OperationMode.local
 
     # noinspection PyNestedDecorators
     @field_validator(
@@ -65,6 +182,10 @@ class Config(BaseSettings):
         'global_profile_dir',
         'nix_cache_dir',
         'empty_dir',
+        'logs_dir',
+        'result_cache_dir',
+        'dir_cache_dir',
+        'image_store_dir',
         mode='before',
     )
     @classmethod
@@ -92,4 +213,4 @@ else:
 config = Config(**config_values, _env_file='.env', _env_prefix='FOXBUILD_')
 (config.profiles_dir / 'tmp').parent.mkdir(exist_ok=True)
 
-__all__ = ['OperationMode', 'config']
+__all__ = ['OperationMode', 'WorkspaceMode', 'SandboxBackend', 'config']
@@ -2,3 +2,5 @@ SANDBOX_USER = 'build'
 SANDBOX_HOME = f'/home/{SANDBOX_USER}'
 SANDBOX_WORKDIR = f'{SANDBOX_HOME}/repo'
 DEFAULT_IMAGE = 'empty'
+SANDBOX_IMAGE_STORE = '/var/lib/foxbuild-images'
+SANDBOX_STORAGE_CONF = '/etc/foxbuild/storage.conf'
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from foxbuild.job_queue import Job, job_queue, JobQueue
+from foxbuild.schemas import StageResult
+
+if TYPE_CHECKING:
+    from foxbuild.runner.runner import Runner
+
+logger = logging.getLogger(__name__)
+
+STAGE_JOB = 'stage'
+# how often claim() looks for jobs whose lease expired
+CLAIM_POLL_INTERVAL = 5
+
+
+class StaleJobError(Exception):
+    # the job was cancelled, finished or taken over by another worker
+    pass
+
+
+@dataclass
+class _PendingStage:
+    future: asyncio.Future
+    log_file: Path
+    job: Job | None = None
+
+
+class StageDispatcher:
+    # Hands stages of runs of this process to remote workers as `stage` jobs.
+    # Workers long-poll claim(), keep the job leased with heartbeats, upload
+    # the log as it grows and post the result, which resolves the future the
+    # run is waiting on. A job that's leased again after its lease expired
+    # gets a new attempt number, and calls with an old one are rejected
+    queue: JobQueue
+    _pending: dict[int, _PendingStage]
+    _wakeup: asyncio.Event
+
+    def __init__(self, queue: JobQueue):
+        self.queue = queue
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+
+    def start(self):
+        # nothing waits for stages queued by a previous process
+        cancelled = self.queue.cancel_all(STAGE_JOB)
+        if cancelled:
+            logger.info(f'Cancelled {cancelled} orphaned stage jobs')
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def _notify(self):
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    async def run_stage(self, payload: dict, log_file: Path) -> StageResult:
+        job_id = self.queue.enqueue(STAGE_JOB, payload)
+        pending = _PendingStage(asyncio.get_running_loop().create_future(), log_file)
+        self._pending[job_id] = pending
+        self._notify()
+        try:
+            return await pending.future
+        finally:
+            # the worker learns about it on its next heartbeat
+            self.queue.cancel(job_id)
+            del self._pending[job_id]
+
+    def _fail_pending(self, job: Job, error: str, *, retry: bool = True):
+        future = self._pending[job.id].future
+        self.queue.fail(job, error, retry=retry)
+        if retry and not job.is_last_attempt:
+            self._notify()
+        elif not future.done():
+            future.set_exception(ValueError(f'Stage failed on a worker: {error}'))
+
+    async def claim(self, timeout: float) -> Job | None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            job = self.queue.claim(STAGE_JOB)
+            if job is not None and job.id not in self._pending:
+                self.queue.cancel(job.id)
+                continue
+            if job is not None and job.attempts > job.max_attempts:
+                # leases of all attempts expired
+                self._fail_pending(job, 'Worker lost', retry=False)
+                continue
+            if job is not None:
+                pending = self._pending[job.id]
+                pending.job = job
+                pending.log_file.parent.mkdir(parents=True, exist_ok=True)
+                pending.log_file.write_bytes(b'')
+                return job
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), min(remaining, CLAIM_POLL_INTERVAL)
+                )
+            except TimeoutError:
+                pass
+
+    def _get_pending(self, job_id: int, attempt: int) -> _PendingStage:
+        pending = self._pending.get(job_id)
+        if (
+            pending is None
+            or pending.job is None
+            or pending.job.attempts != attempt
+            or pending.future.done()
+        ):
+            raise StaleJobError
+        return pending
+
+    def heartbeat(self, job_id: int, attempt: int):
+        pending = self._get_pending(job_id, attempt)
+        if not self.queue.extend_lease(pending.job):
+            raise StaleJobError
+
+    def append_log(self, job_id: int, attempt: int, offset: int, data: bytes) -> int:
+        # returns the log size, uploads are retried from there
+        pending = self._get_pending(job_id, attempt)
+        with open(pending.log_file, 'r+b') as f:
+            size = f.seek(0, 2)
+            if offset <= size:
+                f.seek(offset)
+                f.write(data)
+                size = max(size, offset + len(data))
+        return size
+
+    def complete(self, job_id: int, attempt: int, result: StageResult):
+        pending = self._get_pending(job_id, attempt)
+        self.queue.complete(pending.job)
+        pending.future.set_result(
+            result.model_copy(update={'log_file': str(pending.log_file)})
+        )
+
+    def fail(self, job_id: int, attempt: int, error: str):
+        pending = self._get_pending(job_id, attempt)
+        logger.warning(f'Stage job {job_id} failed on a worker: {error}')
+        self._fail_pending(pending.job, error)
+        pending.job = None
+
+
+class RemoteStageRunner:
+    # Stand-in for StageRunner that runs the stage on a worker
+    runner: 'Runner'
+    key: str
+    workflow_name: str
+    stage_name: str
+    log_file: Path
+
+    def __init__(
+        self,
+        workflow_stage_key: str,
+        runner: 'Runner',
+        workflow_name: str,
+        stage_name: str,
+    ):
+        self.runner = runner
+        self.key = workflow_stage_key
+        self.workflow_name = workflow_name
+        self.stage_name = stage_name
+        self.log_file = runner.logs_dir / f'{workflow_stage_key}.log'
+
+    async def run(self) -> StageResult:
+        payload = {
+            'run_info': self.runner.run_info.model_dump(mode='json'),
+            'foxfile': self.runner.foxfile.model_dump(mode='json', by_alias=True),
+            'key': self.key,
+            'workflow': self.workflow_name,
+            'stage': self.stage_name,
+        }
+        return await stage_dispatcher.run_stage(payload, self.log_file)
+
+
+stage_dispatcher = StageDispatcher(job_queue)
+
+__all__ = [
+    'StaleJobError',
+    'StageDispatcher',
+    'RemoteStageRunner',
+    'stage_dispatcher',
+    'STAGE_JOB',
+]
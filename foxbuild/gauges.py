@@ -0,0 +1,73 @@
+from foxbuild.config import config
+from foxbuild.coordinator import stage_dispatcher
+from foxbuild.janitor import janitor
+from foxbuild.job_queue import job_queue
+from foxbuild.metrics import Gauge
+from foxbuild.runner.budget import stage_budget
+from foxbuild.runner.dir_cache import dir_cache
+from foxbuild.runner.profiles import profile_store
+from foxbuild.runner.result_cache import result_cache
+from foxbuild.sandbox_pool import sandbox_pool
+
+_registered = False
+
+
+def register_gauges():
+    # by the server and by workers, each reports its own state
+    global _registered
+    if _registered:
+        return
+    _registered = True
+    Gauge(
+        'foxbuild_queue_depth',
+        'Queued and running jobs',
+        lambda: job_queue.depth() if job_queue.is_open else None,
+    )
+    Gauge(
+        'foxbuild_stages_running',
+        'Stages running in this process',
+        lambda: stage_budget.in_use,
+    )
+    Gauge(
+        'foxbuild_stages_waiting',
+        'Stages waiting for capacity in this process',
+        lambda: stage_budget.waiting,
+    )
+    Gauge(
+        'foxbuild_remote_stages_pending',
+        'Stages queued for or running on workers',
+        lambda: stage_dispatcher.pending if config.coordinator else None,
+    )
+    Gauge(
+        'foxbuild_profiles',
+        'Profiles in the profile store',
+        lambda: len(profile_store.index.entries),
+    )
+    Gauge(
+        'foxbuild_profiles_bytes',
+        'Closure size of profiles in the profile store',
+        lambda: profile_store.index.total_size,
+    )
+    Gauge(
+        'foxbuild_result_cache_bytes',
+        'Size of the stage result cache',
+        lambda: result_cache.index.total_size,
+    )
+    Gauge(
+        'foxbuild_dir_cache_bytes',
+        'Size of the stage directory cache',
+        lambda: dir_cache.index.total_size,
+    )
+    Gauge(
+        'foxbuild_runs_dir_bytes',
+        'Disk usage of runs_dir',
+        lambda: janitor.runs_dir_size,
+    )
+    Gauge(
+        'foxbuild_sandbox_pool_size',
+        'Idle and starting pooled sandboxes',
+        lambda: sandbox_pool.size,
+    )
+
+
+__all__ = ['register_gauges']
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+from datetime import datetime
+from importlib.util import find_spec
+from time import perf_counter, time
+
+import httpx
+from joserfc import jwt
+
+from foxbuild.config import config
+from foxbuild.metrics import github_request_seconds
+
+logger = logging.getLogger(__name__)
+
+GH_API_BASE = 'https://api.github.com'
+JWT_LIFETIME = 10 * 60
+# GitHub allows for clock drift by accepting iat in the past
+JWT_BACKDATE = 60
+# cached credentials are renewed this long before they expire
+REFRESH_MARGIN = 5 * 60
+# requests below this many remaining are reserved for important updates
+RATE_LIMIT_RESERVE = 100
+RATE_LIMIT_RETRIES = 3
+
+
+class RateLimit:
+    # Last known state of one rate limit budget, from the response headers
+    remaining: int | None
+    reset_at: float
+    blocked_until: float
+
+    def __init__(self):
+        self.remaining = None
+        self.reset_at = 0
+        self.blocked_until = 0
+
+    @property
+    def is_low(self) -> bool:
+        return (
+            self.remaining is not None
+            and self.remaining < RATE_LIMIT_RESERVE
+            and self.reset_at > time()
+        )
+
+    def update(self, resp: httpx.Response):
+        headers = resp.headers
+        if 'x-ratelimit-remaining' in headers:
+            self.remaining = int(headers['x-ratelimit-remaining'])
+            self.reset_at = float(headers.get('x-ratelimit-reset', 0))
+        if 'retry-after' in headers:
+            self.blocked_until = time() + float(headers['retry-after'])
+        elif resp.status_code in (403, 429) and self.remaining == 0:
+            self.blocked_until = self.reset_at
+
+    def is_limited(self, resp: httpx.Response) -> bool:
+        return resp.status_code in (403, 429) and self.blocked_until > time()
+
+    async def wait(self):
+        now = time()
+        until = self.blocked_until
+        if self.remaining == 0 and self.reset_at > now:
+            until = max(until, self.reset_at)
+        if until > now:
+            logger.warning(f'GitHub rate limit reached, waiting {until - now:.0f}s')
+            await asyncio.sleep(until - now)
+
+
+class InstallationClient:
+    # httpx.AsyncClient-like view of GitHubClient authenticated as one
+    # installation
+    _github: 'GitHubClient'
+    installation_id: int
+
+    def __init__(self, github: 'GitHubClient', installation_id: int):
+        self._github = github
+        self.installation_id = installation_id
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        return await self._github.request(
+            method, url, installation_id=self.installation_id, **kwargs
+        )
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('POST', url, **kwargs)
+
+    async def patch(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('PATCH', url, **kwargs)
+
+    @property
+    def rate_limit(self) -> RateLimit:
+        return self._github.rate_limit(self.installation_id)
+
+
+class GitHubClient:
+    # One keep-alive connection pool for the app and all installations.
+    # The app JWT and installation tokens are cached until shortly before
+    # they expire, concurrent refreshes of a token are merged into one.
+    # Requests wait while the rate limit of their installation is exhausted
+    _client: httpx.AsyncClient | None
+    _jwt: str | None
+    _jwt_expires_at: float
+    _tokens: dict[int, tuple[str, float]]
+    _inflight: dict[int, asyncio.Task]
+    # None is the app itself
+    _rate_limits: dict[int | None, RateLimit]
+
+    def __init__(self):
+        self._client = None
+        self._jwt = None
+        self._jwt_expires_at = 0
+        self._tokens = {}
+        self._inflight = {}
+        self._rate_limits = {}
+
+    def rate_limit(self, installation_id: int | None) -> RateLimit:
+        if (res := self._rate_limits.get(installation_id)) is None:
+            res = self._rate_limits[installation_id] = RateLimit()
+        return res
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=GH_API_BASE,
+                headers={'Accept': 'application/vnd.github+json'},
+                # requires the h2 package
+                http2=find_spec('h2') is not None,
+                limits=httpx.Limits(max_keepalive_connections=20),
+            )
+        return self._client
+
+    def app_jwt(self) -> str:
+        now = time()
+        if self._jwt is None or self._jwt_expires_at - REFRESH_MARGIN < now:
+            iat = int(now) - JWT_BACKDATE
+            self._jwt_expires_at = iat + JWT_LIFETIME
+            self._jwt = jwt.encode(
+                {'alg': 'RS256'},
+                {'iat': iat, 'exp': iat + JWT_LIFETIME, 'iss': config.gh_app_id},
+                config.gh_key,
+            )
+        return self._jwt
+
+    async def _create_installation_token(self, installation_id: int) -> str:
+        resp = await self._send(
+            'POST', f'/app/installations/{installation_id}/access_tokens', None
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        expires_at = datetime.fromisoformat(data['expires_at']).timestamp()
+        self._tokens[installation_id] = data['token'], expires_at
+        return data['token']
+
+    def _forget_inflight(self, installation_id: int, task: asyncio.Task):
+        if self._inflight.get(installation_id) is task:
+            del self._inflight[installation_id]
+
+    async def installation_token(self, installation_id: int) -> str:
+        cached = self._tokens.get(installation_id)
+        if cached and cached[1] - REFRESH_MARGIN > time():
+            return cached[0]
+        task = self._inflight.get(installation_id)
+        if task is None:
+            task = asyncio.create_task(self._create_installation_token(installation_id))
+            self._inflight[installation_id] = task
+            task.add_done_callback(lambda t: self._forget_inflight(installation_id, t))
+        # a cancelled waiter mustn't cancel the refresh for everyone else
+        return await asyncio.shield(task)
+
+    async def _send(
+        self, method: str, url: str, installation_id: int | None, **kwargs
+    ) -> httpx.Response:
+        rate_limit = self.rate_limit(installation_id)
+        for _ in range(RATE_LIMIT_RETRIES):
+            await rate_limit.wait()
+            if installation_id is None:
+                token = self.app_jwt()
+            else:
+                token = await self.installation_token(installation_id)
+            headers = {**kwargs.get('headers', {}), 'Authorization': f'Bearer {token}'}
+            start = perf_counter()
+            resp = await self.client.request(
+                method, url, **{**kwargs, 'headers': headers}
+            )
+            github_request_seconds.observe(
+                perf_counter() - start, method=method, status=resp.status_code
+            )
+            rate_limit.update(resp)
+            if not rate_limit.is_limited(resp):
+                break
+        return resp
+
+    async def request(
+        self, method: str, url: str, *, installation_id: int | None = None, **kwargs
+    ) -> httpx.Response:
+        resp = await self._send(method, url, installation_id, **kwargs)
+        if resp.status_code == 401 and installation_id is not None:
+            # revoked or expired early, get a new one once
+            logger.warning(f'Installation token for {installation_id} was rejected')
+            token = resp.request.headers['authorization'].removeprefix('Bearer ')
+            if self._tokens.get(installation_id, (None,))[0] == token:
+                del self._tokens[installation_id]
+            resp = await self._send(method, url, installation_id, **kwargs)
+        return resp
+
+    def installation(self, installation_id: int) -> InstallationClient:
+        return InstallationClient(self, installation_id)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+github = GitHubClient()
+
+__all__ = ['RateLimit', 'GitHubClient', 'InstallationClient', 'github']
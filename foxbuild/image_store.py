@@ -0,0 +1,161 @@
+import asyncio
+import fcntl
+import json
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+
+from foxbuild.config import config
+from foxbuild.const import SANDBOX_HOME, SANDBOX_IMAGE_STORE
+from foxbuild.utils import async_check_output, PODMAN
+
+logger = logging.getLogger(__name__)
+
+STORAGE_CONF = f'''[storage]
+driver = "overlay"
+graphroot = "{SANDBOX_HOME}/.local/share/containers/storage"
+runroot = "/run/user/1000/containers"
+
+[storage.options]
+additionalimagestores = ["{SANDBOX_IMAGE_STORE}"]
+'''
+
+
+class ImageStore:
+    # Host managed podman storage, mounted read-only into every sandbox as an
+    # additional image store. Podman in the sandbox uses images from it and
+    # keeps its own containers and pulls in the per-sandbox graphroot.
+    # Pulling an image that's already there only compares the digests.
+    # The host podman can't see containers in sandboxes, so an old version
+    # of an image is only removed image_store_replaced_retention after a pull
+    # replaced it. replaced.json records when, for all processes on the host
+    root: Path
+    _pulled_at: dict[str, float]
+    _inflight: dict[str, asyncio.Task]
+    _loop_task: asyncio.Task | None
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._pulled_at = {}
+        self._inflight = {}
+        self._loop_task = None
+
+    @property
+    def storage_dir(self) -> Path:
+        return self.root / 'storage'
+
+    @property
+    def storage_conf(self) -> Path:
+        # for podman in the sandbox
+        if not (res := self.root / 'storage.conf').is_file():
+            self.storage_dir.mkdir(exist_ok=True)
+            res.write_text(STORAGE_CONF)
+        return res
+
+    @property
+    def runroot_dir(self) -> Path:
+        return self.root / 'run'
+
+    def _podman(self, *args: str) -> list[str]:
+        # local storage, the podman service can't use another root. Its own
+        # runroot, so the locks and state of the service aren't shared
+        return [
+            PODMAN,
+            '--root',
+            str(self.storage_dir),
+            '--runroot',
+            str(self.runroot_dir),
+            *args,
+        ]
+
+    @contextmanager
+    def _replaced(self):
+        with open(self.root / 'replaced.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            file = self.root / 'replaced.json'
+            replaced = json.loads(file.read_text()) if file.is_file() else {}
+            yield replaced
+            tmp_file = file.with_suffix('.tmp')
+            tmp_file.write_text(json.dumps(replaced))
+            tmp_file.replace(file)
+
+    async def _image_ids(self, *filter_args: str) -> set[str]:
+        out = await async_check_output(
+            *self._podman('images', '--quiet', '--no-trunc', *filter_args),
+            cwd=config.empty_dir,
+        )
+        return {x.removeprefix('sha256:') for x in out.split()}
+
+    async def _pull(self, image: str):
+        logger.info(f'Pulling {image} into the shared image store')
+        old_ids = await self._image_ids(image)
+        await async_check_output(
+            *self._podman('pull', '--quiet', image), cwd=config.empty_dir
+        )
+        self._pulled_at[image] = time()
+        if replaced_ids := old_ids - await self._image_ids(image):
+            with self._replaced() as replaced:
+                for image_id in replaced_ids:
+                    replaced.setdefault(image_id, time())
+
+    def _forget(self, image: str, task: asyncio.Task):
+        if self._inflight.get(image) is task:
+            del self._inflight[image]
+
+    async def ensure(self, images: list[str]):
+        tasks = []
+        for image in images:
+            pulled_at = self._pulled_at.get(image, 0)
+            if pulled_at > time() - config.image_store_refresh_interval:
+                continue
+            if (task := self._inflight.get(image)) is None:
+                task = asyncio.create_task(self._pull(image))
+                self._inflight[image] = task
+                task.add_done_callback(lambda t, image=image: self._forget(image, t))
+            tasks.append(task)
+        # a cancelled stage mustn't cancel the pull for other stages
+        await asyncio.shield(asyncio.gather(*tasks))
+
+    async def prune(self):
+        # old versions of refreshed images, once stages can't use them anymore
+        dangling = await self._image_ids('--filter', 'dangling=true')
+        deadline = time() - config.image_store_replaced_retention
+        with self._replaced() as replaced:
+            for image_id in list(replaced):
+                # removed, or tagged again
+                if image_id not in dangling:
+                    del replaced[image_id]
+            # replaced before they were recorded
+            for image_id in dangling - replaced.keys():
+                replaced[image_id] = time()
+            expired = [x for x in dangling if replaced[x] < deadline]
+        if not expired:
+            return
+        logger.info(f'Removing {len(expired)} replaced images from the shared store')
+        await async_check_output(
+            *self._podman('image', 'rm', '--ignore', *expired), cwd=config.empty_dir
+        )
+
+    async def _prune_loop(self):
+        while True:
+            await asyncio.sleep(config.image_store_prune_interval)
+            try:
+                await self.prune()
+            except ValueError:
+                logger.exception('Failed to prune the shared image store')
+
+    def start(self):
+        if config.nested_image_store:
+            self._loop_task = asyncio.create_task(self._prune_loop())
+
+    async def stop(self):
+        if self._loop_task:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+
+
+image_store = ImageStore(config.image_store_dir)
+
+__all__ = ['ImageStore', 'image_store']
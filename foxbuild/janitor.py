@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import shutil
+from contextlib import ExitStack
+from pathlib import Path
+from time import time
+
+from foxbuild.config import config
+from foxbuild.metrics import janitor_reclaimed_bytes
+from foxbuild.runner.status import run_registry
+from foxbuild.runner.workspace import try_lock_run_dir
+from foxbuild.sandbox import remove_trees
+from foxbuild.utils import async_call, UMOUNT
+
+logger = logging.getLogger(__name__)
+
+# walking runs_dir on every metrics scrape would be too slow
+RUNS_DIR_SIZE_TTL = 60
+
+
+def _tree_size(path: Path) -> int:
+    res = 0
+    for root, dirs, files in os.walk(path, onerror=lambda e: None):
+        for name in (*dirs, *files):
+            try:
+                res += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return res
+
+
+def _list_runs(root: Path) -> list[tuple[float, Path]]:
+    # (mtime, dir) of runs not running in this process, oldest first
+    res = []
+    for provider_dir in root.iterdir() if root.is_dir() else ():
+        for run_dir in provider_dir.iterdir():
+            if run_registry.is_active(provider_dir.name, run_dir.name):
+                continue
+            try:
+                res.append((run_dir.stat().st_mtime, run_dir))
+            except FileNotFoundError:
+                continue
+    res.sort()
+    return res
+
+
+def _is_used(run_dir: Path) -> bool:
+    # by stages of any process on the host, see hold_run
+    if (lock := try_lock_run_dir(run_dir)) is None:
+        return True
+    lock.close()
+    return False
+
+
+class Janitor:
+    # Periodically removes run dirs past runs_retention, or the oldest ones
+    # while they take more than runs_max_size, and logs past logs_retention.
+    # Removal happens in batches, with one process per batch
+    reclaimed_bytes: int
+    runs_dir_size: int | None
+    _runs_dir_size_at: float
+    _loop_task: asyncio.Task | None
+
+    def __init__(self):
+        self.reclaimed_bytes = 0
+        self.runs_dir_size = None
+        self._runs_dir_size_at = 0
+        self._loop_task = None
+
+    async def update_runs_dir_size(self):
+        if self._runs_dir_size_at > time() - RUNS_DIR_SIZE_TTL:
+            return
+        self._runs_dir_size_at = time()
+        self.runs_dir_size = await asyncio.to_thread(_tree_size, config.runs_dir)
+
+    async def _unmount_leftovers(self, run_dir: Path):
+        # overlay workspaces of runs interrupted by a restart
+        for workspace in run_dir.iterdir():
+            if workspace.is_mount():
+                await async_call(UMOUNT, '-l', str(workspace), cwd=config.empty_dir)
+
+    async def _remove(self, dirs: list[Path]) -> int:
+        # run dirs are locked while they're removed, so no stage of another
+        # process on the host starts using them meanwhile
+        reclaimed = 0
+        for i in range(0, len(dirs), config.janitor_batch_size):
+            with ExitStack() as stack:
+                batch = []
+                for run_dir in dirs[i : i + config.janitor_batch_size]:
+                    # may have started since the dirs were listed
+                    if run_registry.is_active(run_dir.parent.name, run_dir.name):
+                        continue
+                    if (lock := try_lock_run_dir(run_dir)) is None:
+                        continue
+                    stack.enter_context(lock)
+                    batch.append(run_dir)
+                sizes = await asyncio.gather(
+                    *(asyncio.to_thread(_tree_size, x) for x in batch)
+                )
+                for run_dir in batch:
+                    await self._unmount_leftovers(run_dir)
+                try:
+                    await remove_trees(batch)
+                except ValueError:
+                    logger.exception(f'Failed to remove {len(batch)} dirs')
+                    continue
+                reclaimed += sum(sizes)
+        return reclaimed
+
+    def _expired_logs(self) -> list[Path]:
+        deadline = time() - config.logs_retention
+        return [x for mtime, x in _list_runs(config.logs_dir) if mtime < deadline]
+
+    async def _expired_runs(self) -> list[Path]:
+        runs = [
+            (mtime, x) for mtime, x in _list_runs(config.runs_dir) if not _is_used(x)
+        ]
+        deadline = time() - config.runs_retention
+        expired = [x for mtime, x in runs if mtime < deadline]
+        if config.runs_max_size is None:
+            return expired
+        kept = [x for mtime, x in runs if mtime >= deadline]
+        sizes = await asyncio.gather(*(asyncio.to_thread(_tree_size, x) for x in kept))
+        total_size = sum(sizes)
+        for run_dir, size in zip(kept, sizes):
+            if total_size <= config.runs_max_size:
+                break
+            expired.append(run_dir)
+            total_size -= size
+        return expired
+
+    async def sweep(self) -> int:
+        reclaimed = await self._remove(await self._expired_runs())
+        # logs are written by this process, no need for remove_trees
+        for log_dir in self._expired_logs():
+            reclaimed += await asyncio.to_thread(_tree_size, log_dir)
+            await asyncio.to_thread(shutil.rmtree, log_dir, True)
+        self.reclaimed_bytes += reclaimed
+        janitor_reclaimed_bytes.inc(reclaimed)
+        if reclaimed:
+            logger.info(f'Reclaimed {reclaimed} bytes')
+        return reclaimed
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception('Janitor sweep failed')
+            await asyncio.sleep(config.janitor_interval)
+
+    def start(self):
+        self._loop_task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._loop_task:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+
+
+janitor = Janitor()
+
+__all__ = ['Janitor', 'janitor']
@@ -0,0 +1,359 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from time import time
+from typing import Any, Awaitable, Callable
+
+from foxbuild.config import config
+from foxbuild.exceptions import ConfigurationError
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_until REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_available ON jobs (status, available_at);
+CREATE TABLE IF NOT EXISTS deliveries (
+    id TEXT PRIMARY KEY,
+    received_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS group_heads (
+    name TEXT PRIMARY KEY,
+    revision TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+'''
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    payload: Any
+    attempts: int
+    max_attempts: int
+    created_at: float
+
+    @property
+    def is_last_attempt(self) -> bool:
+        return self.attempts >= self.max_attempts
+
+
+class JobQueue:
+    path: Path
+    lease_seconds: float
+    max_attempts: int
+    retry_delay: float
+    _db: sqlite3.Connection | None
+
+    def __init__(
+        self,
+        path: Path,
+        *,
+        lease_seconds: float,
+        max_attempts: int,
+        retry_delay: float,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._db = None
+
+    def open(self):
+        self._db = sqlite3.connect(self.path, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    @property
+    def is_open(self) -> bool:
+        return self._db is not None
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so nothing can change
+        # between the reads and the writes based on them, e.g. two claimers
+        # can't pick the same row
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def enqueue(self, kind: str, payload: Any) -> int:
+        now = time()
+        cur = self._db.execute(
+            'INSERT INTO jobs (kind, payload, available_at, created_at) '
+            'VALUES (?, ?, ?, ?)',
+            (kind, json.dumps(payload), now, now),
+        )
+        return cur.lastrowid
+
+    def claim(self, kind: str | None = None) -> Job | None:
+        now = time()
+        with self.transaction():
+            row = self._db.execute(
+                "SELECT id, kind, payload, attempts, created_at FROM jobs "
+                "WHERE ((status = 'queued' AND available_at <= ?) "
+                "OR (status = 'running' AND lease_until < ?)) "
+                "AND (? IS NULL OR kind = ?) "
+                "ORDER BY available_at, id LIMIT 1",
+                (now, now, kind, kind),
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, kind, payload, attempts, created_at = row
+            self._db.execute(
+                "UPDATE jobs SET status = 'running', attempts = ?, lease_until = ? "
+                "WHERE id = ?",
+                (attempts + 1, now + self.lease_seconds, job_id),
+            )
+        return Job(
+            id=job_id,
+            kind=kind,
+            payload=json.loads(payload),
+            attempts=attempts + 1,
+            max_attempts=self.max_attempts,
+            created_at=created_at,
+        )
+
+    def get_queued(self, kind: str) -> list[Job]:
+        rows = self._db.execute(
+            "SELECT id, payload, attempts, created_at FROM jobs "
+            "WHERE status = 'queued' AND kind = ? ORDER BY id",
+            (kind,),
+        ).fetchall()
+        return [
+            Job(
+                id=job_id,
+                kind=kind,
+                payload=json.loads(payload),
+                attempts=attempts,
+                max_attempts=self.max_attempts,
+                created_at=created_at,
+            )
+            for job_id, payload, attempts, created_at in rows
+        ]
+
+    def extend_lease(self, job: Job) -> bool:
+        # False if the job was cancelled or its lease was taken over
+        cur = self._db.execute(
+            "UPDATE jobs SET lease_until = ? "
+            "WHERE id = ? AND attempts = ? AND status = 'running'",
+            (time() + self.lease_seconds, job.id, job.attempts),
+        )
+        return cur.rowcount == 1
+
+    def get_running(self, job_id: int, attempts: int) -> Job | None:
+        row = self._db.execute(
+            "SELECT kind, payload, created_at FROM jobs "
+            "WHERE id = ? AND attempts = ? AND status = 'running'",
+            (job_id, attempts),
+        ).fetchone()
+        if row is None:
+            return None
+        kind, payload, created_at = row
+        return Job(
+            id=job_id,
+            kind=kind,
+            payload=json.loads(payload),
+            attempts=attempts,
+            max_attempts=self.max_attempts,
+            created_at=created_at,
+        )
+
+    def cancel(self, job_id: int):
+        self._db.execute(
+            "UPDATE jobs SET status = 'cancelled', lease_until = NULL, "
+            "finished_at = ? "
+            "WHERE id = ? AND status IN ('queued', 'running')",
+            (time(), job_id),
+        )
+
+    def cancel_all(self, kind: str) -> int:
+        cur = self._db.execute(
+            "UPDATE jobs SET status = 'cancelled', lease_until = NULL, "
+            "finished_at = ? "
+            "WHERE kind = ? AND status IN ('queued', 'running')",
+            (time(), kind),
+        )
+        return cur.rowcount
+
+    def complete(self, job: Job):
+        self._db.execute(
+            "UPDATE jobs SET status = 'done', lease_until = NULL, finished_at = ? "
+            "WHERE id = ?",
+            (time(), job.id),
+        )
+
+    def fail(self, job: Job, error: str, *, retry: bool = True):
+        if retry and not job.is_last_attempt:
+            self._db.execute(
+                "UPDATE jobs SET status = 'queued', lease_until = NULL, "
+                "available_at = ?, last_error = ? WHERE id = ?",
+                (time() + self.retry_delay * job.attempts, error, job.id),
+            )
+        else:
+            self._db.execute(
+                "UPDATE jobs SET status = 'failed', lease_until = NULL, "
+                "last_error = ?, finished_at = ? WHERE id = ?",
+                (error, time(), job.id),
+            )
+
+    def recover(self, kind: str | None = None) -> int:
+        # this process is the only consumer of kind, so anything still
+        # running was interrupted by a restart
+        cur = self._db.execute(
+            "UPDATE jobs SET status = 'queued', lease_until = NULL, available_at = ? "
+            "WHERE status = 'running' AND (? IS NULL OR kind = ?)",
+            (time(), kind, kind),
+        )
+        return cur.rowcount
+
+    def record_delivery(self, delivery_id: str, window: float) -> bool:
+        # False if the delivery was already seen in the last window seconds
+        now = time()
+        self._db.execute(
+            'DELETE FROM deliveries WHERE received_at < ?', (now - window,)
+        )
+        cur = self._db.execute(
+            'INSERT OR IGNORE INTO deliveries (id, received_at) VALUES (?, ?)',
+            (delivery_id, now),
+        )
+        return cur.rowcount == 1
+
+    def set_group_head(self, name: str, revision: str):
+        self._db.execute(
+            'INSERT INTO group_heads (name, revision, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE '
+            'SET revision = excluded.revision, updated_at = excluded.updated_at',
+            (name, revision, time()),
+        )
+
+    def get_group_head(self, name: str) -> tuple[str, float] | None:
+        return self._db.execute(
+            'SELECT revision, updated_at FROM group_heads WHERE name = ?', (name,)
+        ).fetchone()
+
+    def depth(self) -> int:
+        return self._db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+        ).fetchone()[0]
+
+    def next_available_at(self) -> float | None:
+        return self._db.execute(
+            "SELECT MIN(available_at) FROM jobs WHERE status = 'queued'"
+        ).fetchone()[0]
+
+
+class WorkerPool:
+    queue: JobQueue
+    handler: Callable[[Job], Awaitable[None]]
+    concurrency: int
+    poll_interval: float
+    kind: str | None
+    _wakeup: asyncio.Event
+    _tasks: list[asyncio.Task]
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handler: Callable[[Job], Awaitable[None]],
+        *,
+        concurrency: int,
+        poll_interval: float = 5,
+        kind: str | None = None,
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.kind = kind
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    def notify(self):
+        self._wakeup.set()
+
+    def start(self):
+        recovered = self.queue.recover(self.kind)
+        if recovered:
+            logger.info(f'Recovered {recovered} interrupted jobs')
+        self._tasks = [
+            asyncio.create_task(self._worker(i)) for i in range(self.concurrency)
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        # interrupted jobs stay leased and are picked up by recover() on next start
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _keep_leased(self, job: Job):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            self.queue.extend_lease(job)
+
+    async def _wait_for_work(self):
+        timeout = self.poll_interval
+        if (available_at := self.queue.next_available_at()) is not None:
+            timeout = min(timeout, max(available_at - time(), 0))
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _worker(self, idx: int):
+        while True:
+            job = self.queue.claim(self.kind)
+            if job is None:
+                await self._wait_for_work()
+                continue
+            logger.info(f'Worker {idx} running job {job.id} (attempt {job.attempts})')
+            lease_task = asyncio.create_task(self._keep_leased(job))
+            try:
+                await self.handler(job)
+            except ConfigurationError as e:
+                self.queue.fail(job, str(e), retry=False)
+            except Exception as e:
+                logger.exception(f'Job {job.id} failed')
+                self.queue.fail(job, repr(e))
+            else:
+                self.queue.complete(job)
+            finally:
+                lease_task.cancel()
+            # other jobs may have been queued while this one ran
+            self.notify()
+
+
+job_queue = JobQueue(
+    config.data_dir / 'queue.sqlite3',
+    lease_seconds=config.queue_lease_seconds,
+    max_attempts=config.queue_max_attempts,
+    retry_delay=config.queue_retry_delay,
+)
+
+__all__ = ['Job', 'JobQueue', 'WorkerPool', 'job_queue']
@@ -0,0 +1,237 @@
+import asyncio
+import logging
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Awaitable, Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a cached env to a cold nix build
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+_registry: list['_Metric'] = []
+# for the request of a start_server() client
+REQUEST_READ_TIMEOUT = 10
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], **extra) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    )
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    # Minimal in-process metrics in the Prometheus text format. Updates are
+    # plain dict operations on the event loop thread, no locking needed
+    type: str
+    name: str
+    help: str
+    labelnames: tuple[str, ...]
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[x]) for x in self.labelnames)
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}',
+            *self._samples(),
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    type = 'counter'
+    _values: dict[tuple[str, ...], float]
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}{labels} {_format_value(value)}'
+
+
+class Gauge(_Metric):
+    # read when rendered, None skips the sample
+    type = 'gauge'
+    fn: Callable[[], float | None]
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float | None]):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def _samples(self) -> Iterator[str]:
+        if (value := self.fn()) is not None:
+            yield f'{self.name} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+    buckets: tuple[float, ...]
+    # per label values: counts per bucket (not cumulative), sum
+    _values: dict[tuple[str, ...], tuple[list[int], list[float]]]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = (*buckets, float('inf'))
+        self._values = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        if (entry := self._values.get(key)) is None:
+            entry = self._values[key] = ([0] * len(self.buckets), [0.0])
+        counts, total = entry
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def _samples(self) -> Iterator[str]:
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, le=_format_value(bound))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(total[0])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+def render() -> str:
+    return ''.join(metric.render() for metric in _registry)
+
+
+async def start_server(
+    host: str, port: int, on_scrape: Callable[[], Awaitable[None]] | None = None
+) -> asyncio.Server:
+    # Serves render() at /metrics for processes without a web app. One
+    # request per connection is enough for Prometheus
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            async with asyncio.timeout(REQUEST_READ_TIMEOUT):
+                request_line = await reader.readline()
+                while await reader.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+            parts = request_line.decode(errors='replace').split()
+            if parts[:1] == ['GET'] and parts[1:2] == ['/metrics']:
+                if on_scrape:
+                    await on_scrape()
+                status, body = '200 OK', render().encode()
+            else:
+                status, body = '404 Not Found', b''
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: close\r\n\r\n'.encode()
+                + body
+            )
+            await writer.drain()
+        except TimeoutError:
+            logger.debug('Metrics client did not send a request in time')
+        except Exception:
+            logger.exception('Failed to serve metrics')
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+mirror_fetch_seconds = Histogram(
+    'foxbuild_mirror_fetch_seconds', 'Fetching a commit into its mirror'
+)
+checkout_seconds = Histogram(
+    'foxbuild_checkout_seconds',
+    'Creating a run base or a stage workspace',
+    ('mode',),
+)
+foxfile_load_seconds = Histogram('foxbuild_foxfile_load_seconds', 'Loading the foxfile')
+env_resolve_seconds = Histogram(
+    'foxbuild_env_resolve_seconds',
+    'Resolving the nix dev environment of a stage',
+    ('cache',),
+)
+sandbox_start_seconds = Histogram(
+    'foxbuild_sandbox_start_seconds', 'Getting a started sandbox', ('pooled',)
+)
+stage_run_seconds = Histogram(
+    'foxbuild_stage_run_seconds', 'Running the script of a stage', ('result',)
+)
+stage_cleanup_seconds = Histogram(
+    'foxbuild_stage_cleanup_seconds', 'Cleaning up after a stage'
+)
+run_seconds = Histogram('foxbuild_run_seconds', 'Whole check runs', ('result',))
+github_request_seconds = Histogram(
+    'foxbuild_github_request_seconds',
+    'GitHub API requests',
+    ('method', 'status'),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+stage_results_cached = Counter(
+    'foxbuild_stage_results_cached_total', 'Stages whose result was reused'
+)
+janitor_reclaimed_bytes = Counter(
+    'foxbuild_janitor_reclaimed_bytes_total', 'Bytes removed by the janitor'
+)
+
+__all__ = [
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'render',
+    'start_server',
+    'mirror_fetch_seconds',
+    'checkout_seconds',
+    'foxfile_load_seconds',
+    'env_resolve_seconds',
+    'sandbox_start_seconds',
+    'stage_run_seconds',
+    'stage_cleanup_seconds',
+    'run_seconds',
+    'github_request_seconds',
+    'stage_results_cached',
+    'janitor_reclaimed_bytes',
+]
@@ -0,0 +1,281 @@
+import asyncio
+import json
+import logging
+import sys
+from subprocess import DEVNULL, PIPE
+
+import httpx
+
+from foxbuild.sandbox import Sandbox
+
+logger = logging.getLogger(__name__)
+
+API_BASE = 'http://podman/v4.0.0/libpod'
+STDOUT_STREAM = 1
+STDERR_STREAM = 2
+
+_client: httpx.AsyncClient | None = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=Sandbox.PODMAN_SOCKET),
+            base_url=API_BASE,
+            # every running exec holds a connection for its whole duration
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=20),
+            timeout=httpx.Timeout(60),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+class ApiProcess:
+    # Mimics the parts of asyncio.subprocess.Process used for sandboxed
+    # commands. Output is demultiplexed from the attach stream
+    stdout: asyncio.StreamReader | None
+    stderr: asyncio.StreamReader | None
+    returncode: int | None
+    _exec_id: str
+    _stdout_mode: int | None
+    _stderr_mode: int | None
+    _task: asyncio.Task | None
+
+    def __init__(self, exec_id: str, stdout: int | None, stderr: int | None):
+        self._exec_id = exec_id
+        self._stdout_mode = stdout
+        self._stderr_mode = stderr
+        self.stdout = asyncio.StreamReader() if stdout == PIPE else None
+        self.stderr = asyncio.StreamReader() if stderr == PIPE else None
+        self.returncode = None
+        self._task = None
+
+    def _feed(self, stream: int, data: bytes):
+        if stream == STDOUT_STREAM:
+            mode, reader, inherited = self._stdout_mode, self.stdout, sys.stdout
+        elif stream == STDERR_STREAM:
+            mode, reader, inherited = self._stderr_mode, self.stderr, sys.stderr
+        else:
+            return
+        if mode == PIPE:
+            reader.feed_data(data)
+        elif mode is None:
+            inherited.buffer.write(data)
+            inherited.flush()
+
+    async def _pump(self, response: httpx.Response):
+        buf = bytearray()
+        async for chunk in response.aiter_raw():
+            buf += chunk
+            # 8 byte frame header: stream type, 3 zero bytes, big endian size
+            while len(buf) >= 8:
+                size = int.from_bytes(buf[4:8], 'big')
+                if len(buf) < 8 + size:
+                    break
+                self._feed(buf[0], bytes(buf[8 : 8 + size]))
+                del buf[: 8 + size]
+
+    async def _run(self):
+        client = get_client()
+        try:
+            async with client.stream(
+                'POST',
+                f'/exec/{self._exec_id}/start',
+                json={'Detach': False, 'Tty': False},
+                timeout=httpx.Timeout(60, read=None),
+            ) as response:
+                response.raise_for_status()
+                await self._pump(response)
+            while True:
+                resp = await client.get(f'/exec/{self._exec_id}/json')
+                resp.raise_for_status()
+                info = resp.json()
+                if not info['Running']:
+                    break
+                await asyncio.sleep(0.05)
+            self.returncode = info['ExitCode']
+        finally:
+            for reader in (self.stdout, self.stderr):
+                if reader is not None:
+                    reader.feed_eof()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def wait(self) -> int:
+        await self._task
+        return self.returncode
+
+
+class ApiSandbox(Sandbox):
+    # Same sandbox, driven through the libpod REST API instead of the podman
+    # CLI. Commands only run as execs in a session container
+    def _build_spec(self, command: list[str], name: str | None, remove: bool) -> dict:
+        mounts = [
+            {'type': 'tmpfs', 'source': 'tmpfs', 'destination': tmpfs}
+            for tmpfs in self._tmpfses
+        ]
+        for src, dst in self._ro_binds:
+            mounts.append(
+                {
+                    'type': 'bind',
+                    'source': str(src),
+                    'destination': str(dst),
+                    'options': ['rbind', 'ro'],
+                }
+            )
+        for src, dst in self._rw_binds:
+            mounts.append(
+                {
+                    'type': 'bind',
+                    'source': str(src),
+                    'destination': str(dst),
+                    'options': ['rbind'],
+                }
+            )
+        if self._slot:
+            mounts.append(
+                {
+                    'type': 'bind',
+                    'source': str(self._slot[0]),
+                    'destination': self._slot[1],
+                    'options': ['rbind', 'rslave'],
+                }
+            )
+        spec = {
+            'image': self._image,
+            'command': command,
+            'env': dict(self._env),
+            'mounts': mounts,
+            'cap_add': ['SYS_ADMIN'],
+            'labels': {'foxbuild.sandbox': self.id},
+            'remove': remove,
+        }
+        if name:
+            spec['name'] = name
+        if self._workdir:
+            spec['work_dir'] = self._workdir
+        if self._cpus or self._memory:
+            spec['resource_limits'] = {}
+        if self._cpus:
+            period = 100000
+            spec['resource_limits']['cpu'] = {
+                'period': period,
+                'quota': int(self._cpus * period),
+            }
+        if self._memory:
+            spec['resource_limits']['memory'] = {'limit': self._memory}
+        return spec
+
+    async def _create_container(
+        self, command: list[str], name: str | None, *, remove: bool = True
+    ) -> str:
+        client = get_client()
+        resp = await client.post(
+            '/containers/create', json=self._build_spec(command, name, remove)
+        )
+        resp.raise_for_status()
+        container_id = resp.json()['Id']
+        resp = await client.post(f'/containers/{container_id}/start')
+        resp.raise_for_status()
+        return container_id
+
+    async def _start_container(self, name: str, command: list[str]):
+        await self._create_container(command, name)
+
+    async def _create_exec(self, cmd: list[str], env: dict[str, str]) -> str:
+        body = {
+            'AttachStdin': False,
+            'AttachStdout': True,
+            'AttachStderr': True,
+            'Tty': False,
+            'Cmd': cmd,
+            'Env': [f'{k}={v}' for k, v in env.items()],
+        }
+        if self._workdir:
+            body['WorkingDir'] = self._workdir
+        resp = await get_client().post(f'/containers/{self.session}/exec', json=body)
+        resp.raise_for_status()
+        return resp.json()['Id']
+
+    async def exec(
+        self, *args: str, env: dict[str, str] | None = None, stdout=None, stderr=None
+    ) -> ApiProcess:
+        if self._is_shutdown:
+            raise ValueError('Sandbox is shut down')
+        if not self.session:
+            raise ValueError('The api backend can only run commands in a session')
+        # snapshot everything before the first await, like build_cmd_prefix
+        if env:
+            self.add_envs(env)
+        cmd_env = dict(self._env)
+        self.clear_env()
+        cmd = [*self._build_session_user_args(), *args]
+        logger.debug(f'Running {cmd} in {self.session}')
+        p = ApiProcess(await self._create_exec(cmd, cmd_env), stdout, stderr)
+        p.start()
+        return p
+
+    async def _is_session_ready(self) -> bool:
+        exec_id = await self._create_exec(
+            ['test', '-e', self.READY_MARKER], dict(self._env)
+        )
+        p = ApiProcess(exec_id, DEVNULL, DEVNULL)
+        p.start()
+        return not await p.wait()
+
+    async def _remove_session(self):
+        resp = await get_client().delete(
+            f'/containers/{self.session}',
+            params={'force': 'true', 'timeout': 0, 'ignore': 'true'},
+        )
+        if resp.status_code != 404:
+            resp.raise_for_status()
+
+    async def _run_oneoff(self, *args: str):
+        # removed here, an auto-removed container could be gone before the wait
+        client = get_client()
+        container_id = await self._create_container(list(args), None, remove=False)
+        try:
+            resp = await client.post(
+                f'/containers/{container_id}/wait',
+                params={'condition': 'exited'},
+                timeout=httpx.Timeout(60, read=None),
+            )
+            resp.raise_for_status()
+        finally:
+            await client.delete(
+                f'/containers/{container_id}',
+                params={'force': 'true', 'timeout': 0, 'ignore': 'true'},
+            )
+        if code := int(resp.text):
+            logger.error(f'Process exited with code {code}')
+            raise ValueError
+
+    async def kill(self):
+        client = get_client()
+        resp = await client.get(
+            '/containers/json',
+            params={
+                'all': 'true',
+                'filters': json.dumps({'label': [f'foxbuild.sandbox={self.id}']}),
+            },
+        )
+        resp.raise_for_status()
+        for container in resp.json():
+            resp = await client.delete(
+                f'/containers/{container["Id"]}',
+                params={'force': 'true', 'timeout': 0, 'ignore': 'true'},
+            )
+            if resp.status_code != 404:
+                resp.raise_for_status()
+
+
+__all__ = ['ApiSandbox', 'ApiProcess', 'close_client']
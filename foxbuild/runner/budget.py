@@ -0,0 +1,133 @@
+import asyncio
+import os
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from typing import Hashable
+
+from foxbuild.config import config
+
+
+def _host_memory() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+# Process-wide admission control for stages. A stage needs a free slot out of
+# limit, and its cpus and memory reservation must fit into what's left of the
+# host capacity. Freed capacity goes to the waiting owner (run) with the
+# fewest running stages, so one big run can't starve the others. Nothing
+# jumps past that owner's next stage, so big reservations can't starve either.
+# Worker processes don't know about each other, each one gets its share of
+# the host through host_cpus and host_memory
+class StageBudget:
+    limit: int
+    cpus: float
+    memory: int
+    _in_use: int
+    _reserved_cpus: float
+    _reserved_memory: int
+    _running: Counter
+    _waiters: dict[Hashable, deque[tuple[asyncio.Future, float, int]]]
+
+    def __init__(self, limit: int, cpus: float, memory: int):
+        self.limit = limit
+        self.cpus = cpus
+        self.memory = memory
+        self._in_use = 0
+        self._reserved_cpus = 0
+        self._reserved_memory = 0
+        self._running = Counter()
+        self._waiters = {}
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._waiters.values())
+
+    @property
+    def reserved_cpus(self) -> float:
+        return self._reserved_cpus
+
+    @property
+    def reserved_memory(self) -> int:
+        return self._reserved_memory
+
+    def _fits(self, cpus: float, memory: int) -> bool:
+        return (
+            self._in_use < self.limit
+            and self._reserved_cpus + cpus <= self.cpus
+            and self._reserved_memory + memory <= self.memory
+        )
+
+    def _wake_next(self):
+        while self._waiters:
+            owner = min(self._waiters, key=lambda x: self._running[x])
+            queue = self._waiters[owner]
+            fut, cpus, memory = queue[0]
+            if not fut.done() and not self._fits(cpus, memory):
+                break
+            queue.popleft()
+            if not queue:
+                del self._waiters[owner]
+            if fut.done():
+                # cancelled while waiting
+                continue
+            self._in_use += 1
+            self._reserved_cpus += cpus
+            self._reserved_memory += memory
+            self._running[owner] += 1
+            fut.set_result(None)
+
+    def _release(self, owner: Hashable, cpus: float, memory: int):
+        self._in_use -= 1
+        self._reserved_cpus -= cpus
+        self._reserved_memory -= memory
+        self._running[owner] -= 1
+        if not self._running[owner]:
+            del self._running[owner]
+        self._wake_next()
+
+    @asynccontextmanager
+    async def slot(self, owner: Hashable, cpus: float | None, memory: int | None):
+        if cpus is None:
+            cpus = config.stage_default_cpus
+        if memory is None:
+            memory = config.stage_default_memory
+        # a reservation bigger than the host would never fit
+        cpus = min(cpus, self.cpus)
+        memory = min(memory, self.memory)
+        fut = asyncio.get_running_loop().create_future()
+        waiter = fut, cpus, memory
+        self._waiters.setdefault(owner, deque()).append(waiter)
+        self._wake_next()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release(owner, cpus, memory)
+            else:
+                # _wake_next drops cancelled waiters too, it may have run
+                # between the cancel and this
+                queue = self._waiters.get(owner)
+                if queue and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._waiters[owner]
+                # it may have been the one blocking the others
+                self._wake_next()
+            raise
+        try:
+            yield
+        finally:
+            self._release(owner, cpus, memory)
+
+
+stage_budget = StageBudget(
+    config.max_parallel_stages,
+    config.host_cpus or os.cpu_count() or 1,
+    config.host_memory or _host_memory(),
+)
+
+__all__ = ['StageBudget', 'stage_budget']
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import shutil
+import stat
+import tempfile
+from hashlib import sha256
+from pathlib import Path
+from time import time
+
+from foxbuild.config import config
+from foxbuild.runner.lru_index import LruIndex
+from foxbuild.schemas.foxfile import HASH_PLACEHOLDER_RE
+
+logger = logging.getLogger(__name__)
+
+# relative to HOME or to the workdir, whichever the paths are in
+ARCHIVES = ('home', 'workdir')
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _is_regular_file(path: Path) -> bool:
+    try:
+        return stat.S_ISREG(path.lstat().st_mode)
+    except OSError:
+        return False
+
+
+def hash_files(workdir: Path, patterns: list[str]) -> str:
+    # patterns come from the foxfile, symlinks are neither followed nor
+    # allowed to lead out of the workdir
+    workdir = workdir.resolve()
+    files = set()
+    for pattern in patterns:
+        for path in workdir.glob(pattern.strip()):
+            if _is_regular_file(path) and path.resolve().is_relative_to(workdir):
+                files.add(path)
+    res = sha256()
+    for file in sorted(files):
+        res.update(str(file.relative_to(workdir)).encode() + b'\0')
+        file_hash = sha256()
+        with open(file, 'rb') as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                file_hash.update(chunk)
+        res.update(file_hash.digest())
+    return res.hexdigest()
+
+
+def _render_key(template: str, workdir: Path) -> str:
+    return HASH_PLACEHOLDER_RE.sub(
+        lambda m: hash_files(workdir, m.group(1).split(',')), template
+    )
+
+
+async def render_key(template: str, workdir: Path) -> str:
+    return await asyncio.to_thread(_render_key, template, workdir)
+
+
+def split_paths(paths: list[str]) -> dict[str, list[str]]:
+    res = {name: [] for name in ARCHIVES}
+    for path in paths:
+        if path.startswith('~/'):
+            res['home'].append(path.removeprefix('~/'))
+        else:
+            res['workdir'].append(path)
+    return res
+
+
+class DirCache:
+    # Snapshots of cached directories. Every entry is a directory with a
+    # zstd compressed tar for each of ARCHIVES that had existing paths, named
+    # by the hash of its namespace and key. The index also records the
+    # namespace, key and creation time of each one
+    root: Path
+    index: LruIndex
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.index = LruIndex(root)
+
+    def _entry_name(self, namespace: str, key: str) -> str:
+        return sha256(f'{namespace}\0{key}'.encode()).hexdigest()
+
+    def entry_dir(self, name: str) -> Path:
+        return self.root / name
+
+    def find(
+        self, namespace: str, key: str, restore_keys: list[str]
+    ) -> tuple[str, str] | None:
+        # (entry name, its key) for key, or the newest entry matching the
+        # first restore key prefix that has any
+        entries = self.index.entries
+        name = self._entry_name(namespace, key)
+        if name in entries:
+            return name, key
+        for prefix in restore_keys:
+            candidates = [
+                (entry['created'], entry_name, entry['key'])
+                for entry_name, entry in entries.items()
+                if entry['namespace'] == namespace and entry['key'].startswith(prefix)
+            ]
+            if candidates:
+                _, name, found_key = max(candidates)
+                return name, found_key
+        return None
+
+    def touch(self, name: str):
+        self.index.touch(name)
+
+    async def store(self, namespace: str, key: str, src_dir: Path):
+        # takes ownership of src_dir
+        name = self._entry_name(namespace, key)
+        # may be on another file system, unique so other processes can
+        # store the same entry at the same time
+        tmp_dir = Path(tempfile.mkdtemp(dir=self.root, suffix='.tmp'))
+        tmp_dir.rmdir()
+        await asyncio.to_thread(shutil.move, src_dir, tmp_dir)
+        entry_dir = self.entry_dir(name)
+        with self.index.updating() as index:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            tmp_dir.rename(entry_dir)
+            now = time()
+            index[name] = {
+                'namespace': namespace,
+                'key': key,
+                'created': now,
+                'last_used': now,
+                'size': sum(x.stat().st_size for x in entry_dir.iterdir()),
+            }
+            self._evict(index, keep=name)
+
+    def _remove(self, name: str):
+        shutil.rmtree(self.entry_dir(name), ignore_errors=True)
+
+    def _evict(self, index: dict[str, dict], keep: str | None = None):
+        removed = self.index.evict(
+            index,
+            self._remove,
+            config.dir_cache_max_count,
+            config.dir_cache_max_size,
+            keep,
+        )
+        if removed:
+            logger.info(f'Evicted {len(removed)} cached directory snapshots')
+
+    def evict(self):
+        with self.index.updating() as index:
+            self._evict(index)
+
+
+dir_cache = DirCache(config.dir_cache_dir)
+
+__all__ = ['render_key', 'split_paths', 'ARCHIVES', 'DirCache', 'dir_cache']
@@ -0,0 +1,41 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+
+class EnvResolver:
+    # Single-flight for dev environment resolution. Stages (of any run) with
+    # the same key share one in-flight resolution instead of each running
+    # nix print-dev-env on their own
+    _inflight: dict[Hashable, asyncio.Task]
+
+    def __init__(self):
+        self._inflight = {}
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def resolve(
+        self, key: Hashable, do_resolve: Callable[[], Awaitable[dict[str, str]]]
+    ) -> dict[str, str]:
+        while True:
+            task = self._inflight.get(key)
+            is_owner = task is None
+            if is_owner:
+                task = asyncio.create_task(do_resolve())
+                self._inflight[key] = task
+                task.add_done_callback(lambda t: self._forget(key, t))
+            try:
+                return dict(await asyncio.shield(task))
+            except asyncio.CancelledError:
+                if is_owner:
+                    # the resolution runs in the owner's sandbox, which is going away
+                    task.cancel()
+                if asyncio.current_task().cancelling():
+                    raise
+                # the owner was cancelled, but we weren't: resolve again
+
+
+env_resolver = EnvResolver()
+
+__all__ = ['EnvResolver', 'env_resolver']
@@ -0,0 +1,123 @@
+import asyncio
+from pathlib import Path
+from time import monotonic
+from typing import AsyncIterator, BinaryIO, Callable
+
+from foxbuild.config import config
+
+READ_CHUNK = 64 * 1024
+# longer lines are split, so a process without newlines can't grow the buffer
+MAX_LINE = 64 * 1024
+FOLLOW_INTERVAL = 0.5
+
+
+def get_run_logs_dir(provider: str, run_id: str) -> Path:
+    return config.logs_dir / provider / run_id
+
+
+class OutputCapture:
+    # First head_size and last tail_size bytes of a stream
+    head_size: int
+    tail_size: int
+    head: bytearray
+    tail: bytearray
+    size: int
+
+    def __init__(self, head_size: int, tail_size: int):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.size = 0
+
+    def feed(self, data: bytes):
+        self.size += len(data)
+        if len(self.head) < self.head_size:
+            n = self.head_size - len(self.head)
+            self.head += data[:n]
+            data = data[n:]
+        if data:
+            self.tail += data
+            if len(self.tail) > self.tail_size:
+                del self.tail[: len(self.tail) - self.tail_size]
+
+    @property
+    def truncated(self) -> bool:
+        return self.size > len(self.head) + len(self.tail)
+
+    def text(self) -> str:
+        res = self.head.decode(errors='replace')
+        if self.truncated:
+            skipped = self.size - len(self.head) - len(self.tail)
+            res += f'\n[... {skipped} bytes skipped, see the full log ...]\n'
+        return res + self.tail.decode(errors='replace')
+
+
+class StageLog:
+    # Lines are prefixed with seconds since the log was opened and the stream
+    path: Path
+    _file: BinaryIO
+    _start: float
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._file = open(path, 'wb')
+        self._start = monotonic()
+
+    def write_line(self, tag: str, line: bytes):
+        prefix = f'{monotonic() - self._start:.3f} {tag} '.encode()
+        self._file.write(prefix + line + b'\n')
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    async def drain(
+        self, tag: str, reader: asyncio.StreamReader, capture: OutputCapture
+    ):
+        partial = b''
+        while chunk := await reader.read(READ_CHUNK):
+            capture.feed(chunk)
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            if len(partial) > MAX_LINE:
+                lines.append(partial)
+                partial = b''
+            for line in lines:
+                self.write_line(tag, line)
+            # followers read the file while the stage is running
+            self.flush()
+        if partial:
+            self.write_line(tag, partial)
+            self.flush()
+
+
+async def follow_log(
+    path: Path, offset: int, is_active: Callable[[], bool]
+) -> AsyncIterator[tuple[int, bytes]]:
+    # Yields chunks of the log starting at offset together with the offset
+    # after them, until the stage is no longer active and everything is read.
+    # Each follower only keeps its own file position, so there's no point in
+    # a notification mechanism, an empty read is cheap
+    while not path.is_file():
+        if not is_active():
+            return
+        await asyncio.sleep(FOLLOW_INTERVAL)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            # checked before reading, so the last writes are never missed
+            active = is_active()
+            if chunk := f.read(READ_CHUNK):
+                offset += len(chunk)
+                yield offset, chunk
+            elif not active:
+                return
+            else:
+                await asyncio.sleep(FOLLOW_INTERVAL)
+
+
+__all__ = ['get_run_logs_dir', 'OutputCapture', 'StageLog', 'follow_log']
@@ -0,0 +1,95 @@
+import fcntl
+import json
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+from typing import Callable
+
+
+class LruIndex:
+    # index.json of a cache directory, the entries record when each one was
+    # last used and its size. Worker processes on one host share it, so it's
+    # reloaded when another one replaced it and only changed under index.lock
+    root: Path
+    _entries: dict[str, dict] | None
+    _version: tuple[int, int] | None
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._entries = None
+        self._version = None
+
+    @property
+    def _file(self) -> Path:
+        return self.root / 'index.json'
+
+    def _current_version(self) -> tuple[int, int] | None:
+        try:
+            stat = self._file.stat()
+        except FileNotFoundError:
+            return None
+        # the file is replaced on every save
+        return stat.st_ino, stat.st_mtime_ns
+
+    @property
+    def entries(self) -> dict[str, dict]:
+        version = self._current_version()
+        if self._entries is None or version != self._version:
+            if version is not None:
+                self._entries = json.loads(self._file.read_text())
+            else:
+                self._entries = {}
+            self._version = version
+        return self._entries
+
+    @contextmanager
+    def updating(self):
+        # the entries are saved when the block exits without an error
+        with open(self.root / 'index.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield self.entries
+            self._save()
+
+    def _save(self):
+        tmp_file = self._file.with_suffix('.tmp')
+        tmp_file.write_text(json.dumps(self._entries))
+        tmp_file.replace(self._file)
+        self._version = self._current_version()
+
+    @property
+    def total_size(self) -> int:
+        # sizes may be unknown yet
+        return sum(entry['size'] or 0 for entry in self.entries.values())
+
+    def touch(self, name: str):
+        with self.updating() as entries:
+            if name in entries:
+                entries[name]['last_used'] = time()
+
+    def evict(
+        self,
+        entries: dict[str, dict],
+        remove: Callable[[str], None],
+        max_count: int | None,
+        max_size: int | None,
+        keep: str | None = None,
+    ) -> list[str]:
+        # entries of updating(), remove deletes the files of one of them
+        lru = sorted(entries, key=lambda x: entries[x]['last_used'])
+        total_size = sum(entry['size'] or 0 for entry in entries.values())
+        removed = []
+        for name in lru:
+            over_count = max_count is not None and len(entries) > max_count
+            over_size = max_size is not None and total_size > max_size
+            if not over_count and not over_size:
+                break
+            if name == keep:
+                continue
+            total_size -= entries[name]['size'] or 0
+            remove(name)
+            del entries[name]
+            removed.append(name)
+        return removed
+
+
+__all__ = ['LruIndex']
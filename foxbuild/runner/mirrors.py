@@ -0,0 +1,155 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from foxbuild.config import config
+from foxbuild.metrics import mirror_fetch_seconds
+from foxbuild.runner.utils import fetch_commit, get_mirror_path
+from foxbuild.schemas import StandaloneRunInfo
+from foxbuild.utils import async_check_output, GIT
+
+logger = logging.getLogger(__name__)
+
+
+class _MirrorLock:
+    # Readers (fetches, clones, blob reads) share the mirror, maintenance needs
+    # it exclusively. Waiting maintenance blocks new readers, so it can't be
+    # starved on busy repos
+    _cond: asyncio.Condition
+    _readers: int
+    _writer: bool
+    _writers_waiting: int
+    fetch_lock: asyncio.Lock
+
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+        self.fetch_lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def shared(self):
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: not self._writer and not self._writers_waiting
+            )
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @asynccontextmanager
+    async def exclusive(self):
+        async with self._cond:
+            self._writers_waiting += 1
+            try:
+                await self._cond.wait_for(
+                    lambda: not self._writer and not self._readers
+                )
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class MirrorManager:
+    _locks: dict[Path, _MirrorLock]
+    _inflight: dict[tuple[Path, str], asyncio.Task]
+    _background: set[asyncio.Task]
+    _maintenance_task: asyncio.Task | None
+
+    def __init__(self):
+        self._locks = {}
+        self._inflight = {}
+        self._background = set()
+        self._maintenance_task = None
+
+    def _lock(self, repo_path: Path) -> _MirrorLock:
+        if (lock := self._locks.get(repo_path)) is None:
+            lock = self._locks[repo_path] = _MirrorLock()
+        return lock
+
+    @asynccontextmanager
+    async def using(self, run_info: StandaloneRunInfo):
+        repo_path = get_mirror_path(run_info)
+        async with self._lock(repo_path).shared():
+            yield repo_path
+
+    async def _fetch(self, run_info: StandaloneRunInfo) -> Path:
+        lock = self._lock(get_mirror_path(run_info))
+        async with lock.shared(), lock.fetch_lock:
+            with mirror_fetch_seconds.time():
+                return await fetch_commit(run_info)
+
+    async def ensure_commit(self, run_info: StandaloneRunInfo) -> Path:
+        key = (get_mirror_path(run_info), run_info.commit_sha)
+        if (task := self._inflight.get(key)) is None:
+            task = asyncio.create_task(self._fetch(run_info))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # one cancelled waiter must not abort the fetch for the others
+        return await asyncio.shield(task)
+
+    def prefetch(self, run_info: StandaloneRunInfo):
+        async def do_prefetch():
+            try:
+                await self.ensure_commit(run_info)
+            except Exception:
+                logger.exception(
+                    f'Prefetch of {run_info.repo_name}@{run_info.commit_sha} failed'
+                )
+
+        task = asyncio.create_task(do_prefetch())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def maintain(self, repo_path: Path):
+        async with self._lock(repo_path).exclusive():
+            logger.info(f'Running maintenance for {repo_path}')
+            await async_check_output(
+                GIT, 'maintenance', 'run', '--task=gc', cwd=repo_path
+            )
+
+    def _find_mirrors(self) -> list[Path]:
+        # repos_dir/<provider>/<owner>/<repo>
+        return [
+            x
+            for x in config.repos_dir.glob('*/*/*')
+            if x.is_dir() and (x / 'HEAD').is_file()
+        ]
+
+    async def _maintenance_loop(self):
+        while True:
+            await asyncio.sleep(config.mirror_maintenance_interval)
+            for repo_path in self._find_mirrors():
+                try:
+                    await self.maintain(repo_path)
+                except Exception:
+                    logger.exception(f'Maintenance of {repo_path} failed')
+
+    def start(self):
+        self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+
+    async def stop(self):
+        tasks = [*self._background]
+        if self._maintenance_task:
+            tasks.append(self._maintenance_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._maintenance_task = None
+
+
+mirror_manager = MirrorManager()
+
+__all__ = ['MirrorManager', 'mirror_manager']
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import logging
+import re
+from time import time
+
+from foxbuild.config import config
+from foxbuild.utils import async_check_output, GIT
+
+logger = logging.getLogger(__name__)
+
+NIXPKGS_REPO = 'https://github.com/NixOS/nixpkgs'
+DEFAULT_NIXPKGS_REF = 'nixpkgs-unstable'
+
+_pin_lock = asyncio.Lock()
+
+
+def _read_pins() -> dict[str, dict]:
+    pins_file = config.data_dir / 'nixpkgs-pins.json'
+    if not pins_file.is_file():
+        return {}
+    return json.loads(pins_file.read_text())
+
+
+def _write_pins(pins: dict[str, dict]):
+    pins_file = config.data_dir / 'nixpkgs-pins.json'
+    tmp_file = pins_file.with_suffix('.tmp')
+    tmp_file.write_text(json.dumps(pins))
+    tmp_file.replace(pins_file)
+
+
+async def resolve_nixpkgs_rev(ref: str | None) -> str:
+    ref = ref or DEFAULT_NIXPKGS_REF
+    if re.fullmatch(r'[0-9a-f]{40}', ref):
+        return ref
+    if ref == DEFAULT_NIXPKGS_REF and config.nixpkgs_rev:
+        return config.nixpkgs_rev
+    if not re.fullmatch(r'[\w.\-]+', ref):
+        raise ValueError(f'Bad nixpkgs ref {ref}')
+
+    async with _pin_lock:
+        pins = _read_pins()
+        pin = pins.get(ref)
+        if pin and time() - pin['pinned_at'] < config.nixpkgs_pin_ttl:
+            return pin['rev']
+        try:
+            out = await async_check_output(
+                GIT,
+                'ls-remote',
+                NIXPKGS_REPO,
+                f'refs/heads/{ref}',
+                cwd=config.empty_dir,
+            )
+        except ValueError:
+            if pin:
+                logger.warning(f'Failed to refresh nixpkgs {ref}, keeping old pin')
+                return pin['rev']
+            raise
+        if not out:
+            raise ValueError(f'nixpkgs branch {ref} not found')
+        rev = out.split()[0]
+        logger.info(f'Pinned nixpkgs {ref} to {rev}')
+        pins[ref] = {'rev': rev, 'pinned_at': time()}
+        _write_pins(pins)
+        return rev
+
+
+__all__ = ['resolve_nixpkgs_rev']
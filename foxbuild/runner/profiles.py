@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import shutil
+from pathlib import Path
+from time import time
+
+from foxbuild.config import config
+from foxbuild.runner.lru_index import LruIndex
+from foxbuild.utils import async_check_output, NIX
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileStore:
+    # Every profile is a `<name>.rc` file with the dumped environment plus a
+    # `<name>` nix out-link, which is the gc root keeping its closure alive.
+    # The index records when each one was last used and its closure size
+    root: Path
+    index: LruIndex
+    _loop_task: asyncio.Task | None
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.index = LruIndex(root)
+        self._loop_task = None
+
+    def rc_file(self, name: str) -> Path:
+        return self.root / (name + '.rc')
+
+    def gcroot(self, name: str) -> Path:
+        return self.root / name
+
+    def read(self, name: str) -> dict[str, str] | None:
+        # under the index lock, so no other process evicts it meanwhile
+        with self.index.updating() as index:
+            rc_file = self.rc_file(name)
+            if not rc_file.is_file():
+                return None
+            if name in index:
+                index[name]['last_used'] = time()
+            return json.loads(rc_file.read_text())
+
+    async def _closure_size(self, name: str) -> int | None:
+        gcroot = self.gcroot(name)
+        if not gcroot.exists():
+            return None
+        out = await async_check_output(
+            NIX, 'path-info', '--closure-size', str(gcroot), cwd=config.empty_dir
+        )
+        return int(out.split()[-1])
+
+    async def add(self, name: str):
+        try:
+            size = await self._closure_size(name)
+        except ValueError:
+            logger.warning(f'Failed to get closure size of profile {name}')
+            size = None
+        with self.index.updating() as index:
+            index[name] = {'last_used': time(), 'size': size}
+            self._evict(index, keep=name)
+
+    def _remove(self, name: str):
+        self.rc_file(name).unlink(missing_ok=True)
+        # the gc root goes together with the .rc, nix can then collect the closure
+        self.gcroot(name).unlink(missing_ok=True)
+
+    def _evict(self, index: dict[str, dict], keep: str | None = None):
+        removed = self.index.evict(
+            index,
+            self._remove,
+            config.profile_store_max_count,
+            config.profile_store_max_size,
+            keep,
+        )
+        if removed:
+            logger.info(f'Evicted profiles {removed}')
+
+    def evict(self):
+        with self.index.updating() as index:
+            self._evict(index)
+
+    def _add_untracked(self):
+        # profiles created before the index existed
+        with self.index.updating() as index:
+            for rc_file in self.root.glob('*.rc'):
+                name = rc_file.name.removesuffix('.rc')
+                if name not in index:
+                    index[name] = {'last_used': rc_file.stat().st_mtime, 'size': None}
+
+    async def _fill_sizes(self):
+        # nix isn't run under the lock, other processes would block on it
+        sizes = {}
+        for name, entry in list(self.index.entries.items()):
+            if entry['size'] is None:
+                try:
+                    sizes[name] = await self._closure_size(name)
+                except ValueError:
+                    continue
+        if not sizes:
+            return
+        with self.index.updating() as index:
+            for name, size in sizes.items():
+                if name in index:
+                    index[name]['size'] = size
+
+    async def collect_garbage_if_needed(self):
+        min_free = config.nix_gc_min_free
+        if min_free is None:
+            return
+        free = shutil.disk_usage('/nix/store').free
+        if free >= min_free:
+            return
+        # aim for twice the threshold, so gc doesn't run on every check
+        to_free = 2 * min_free - free
+        logger.info(f'Only {free} bytes free in /nix/store, collecting garbage')
+        await async_check_output(
+            NIX, 'store', 'gc', '--max', str(to_free), cwd=config.empty_dir
+        )
+
+    async def _maintenance_loop(self):
+        while True:
+            try:
+                self._add_untracked()
+                await self._fill_sizes()
+                self.evict()
+                await self.collect_garbage_if_needed()
+            except Exception:
+                logger.exception('Profile store maintenance failed')
+            await asyncio.sleep(config.profile_store_check_interval)
+
+    def start(self):
+        self._loop_task = asyncio.create_task(self._maintenance_loop())
+
+    async def stop(self):
+        if self._loop_task:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+
+
+profile_store = ProfileStore(config.profiles_dir)
+
+__all__ = ['ProfileStore', 'profile_store']
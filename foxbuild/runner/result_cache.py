@@ -0,0 +1,84 @@
+import logging
+import shutil
+from pathlib import Path
+from time import time
+
+from foxbuild.config import config
+from foxbuild.runner.lru_index import LruIndex
+from foxbuild.schemas import StageResult
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    # Successful stage results by cache key. Every entry is a `<key>.json`
+    # with the StageResult and a `<key>.log` with its full log
+    root: Path
+    index: LruIndex
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.index = LruIndex(root)
+
+    def _result_file(self, key: str) -> Path:
+        return self.root / (key + '.json')
+
+    def _log_file(self, key: str) -> Path:
+        return self.root / (key + '.log')
+
+    def get(self, key: str, log_file: Path) -> StageResult | None:
+        # the cached log is copied to log_file, like it was written by the stage
+        if key not in self.index.entries:
+            return None
+        try:
+            result = StageResult.model_validate_json(
+                self._result_file(key).read_text()
+            )
+            log_file.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(self._log_file(key), log_file)
+        except (OSError, ValueError):
+            logger.warning(f'Cached result {key} is broken, removing it')
+            with self.index.updating() as index:
+                self._remove(key)
+                index.pop(key, None)
+            return None
+        self.index.touch(key)
+        return result.model_copy(update={'log_file': str(log_file), 'cached': True})
+
+    def put(self, key: str, result: StageResult):
+        result_file = self._result_file(key)
+        log_file = self._log_file(key)
+        with self.index.updating() as index:
+            tmp_file = result_file.with_suffix('.tmp')
+            tmp_file.write_text(result.model_dump_json())
+            shutil.copyfile(result.log_file, log_file)
+            tmp_file.replace(result_file)
+            index[key] = {
+                'last_used': time(),
+                'size': result_file.stat().st_size + log_file.stat().st_size,
+            }
+            self._evict(index, keep=key)
+
+    def _remove(self, key: str):
+        self._result_file(key).unlink(missing_ok=True)
+        self._log_file(key).unlink(missing_ok=True)
+
+    def _evict(self, index: dict[str, dict], keep: str | None = None):
+        removed = self.index.evict(
+            index,
+            self._remove,
+            config.result_cache_max_count,
+            config.result_cache_max_size,
+            keep,
+        )
+        if removed:
+            logger.info(f'Evicted {len(removed)} cached stage results')
+
+    def evict(self):
+        with self.index.updating() as index:
+            self._evict(index)
+
+
+result_cache = ResultCache(config.result_cache_dir)
+
+__all__ = ['ResultCache', 'result_cache']
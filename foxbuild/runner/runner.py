@@ -1,52 +1,141 @@
+import asyncio
+import uuid
 import yaml
+from time import time
+from typing import Callable
+from collections import OrderedDict
 from pathlib import Path
 from pydantic import ValidationError
-from tempfile import TemporaryDirectory
 from yaml import YAMLError
 
-from foxbuild.config import config, OperationMode
+from foxbuild.config import config, OperationMode, WorkspaceMode
 from foxbuild.exceptions import ConfigurationError
-from foxbuild.runner.utils import checkout_repo
+from foxbuild.metrics import foxfile_load_seconds
+from foxbuild.runner.logs import get_run_logs_dir
+from foxbuild.runner.mirrors import mirror_manager
+from foxbuild.runner.status import run_registry
+from foxbuild.runner.utils import get_blob_hash, read_blob, FailFastAbort
 from foxbuild.runner.workflow import WorkflowRunner
-from foxbuild.schemas import StandaloneRunInfo, RunResult
+from foxbuild.runner.workspace import ensure_base
+from foxbuild.schemas import StandaloneRunInfo, RunResult, RunStatus, StageStatus
 from foxbuild.schemas.foxfile import Foxfile
 
+FOXFILE_NAME = 'foxfile.yml'
+FOXFILE_CACHE_SIZE = 256
+
+# validated foxfiles by git blob hash
+_foxfile_cache: OrderedDict[str, Foxfile] = OrderedDict()
+
+
+def parse_foxfile(text: str) -> Foxfile:
+    try:
+        return Foxfile.model_validate(yaml.safe_load(text))
+    except (YAMLError, ValidationError) as e:
+        raise ConfigurationError(str(e))
+
 
 class Runner:
     foxfile: Foxfile | None
     host_workdir: Path | None
     run_info: StandaloneRunInfo | None
+    logs_dir: Path
+    status: RunStatus
+    status_listeners: list[Callable[[RunStatus], None]]
 
     def __init__(self, host_workdir: Path | None, run_info: StandaloneRunInfo | None):
         if host_workdir and run_info or not host_workdir and not run_info:
             raise ValueError(
                 'One and only one of host_workdir and run_info must be set'
             )
-        if config.mode == OperationMode.standalone and run_info is None:
-            raise ValueError('run_info must be set in standalone mode')
+        if config.mode != OperationMode.local and run_info is None:
+            raise ValueError(f'run_info must be set in {config.mode.name} mode')
         self.foxfile = None
         self.host_workdir = host_workdir
         self.run_info = run_info
+        if run_info:
+            provider, run_id = run_info.provider, run_info.run_id
+        else:
+            provider, run_id = 'local', uuid.uuid4().hex
+        self.logs_dir = get_run_logs_dir(provider, run_id)
+        self.status = RunStatus(
+            provider=provider,
+            run_id=run_id,
+            repo_name=run_info and run_info.repo_name,
+            commit_sha=run_info and run_info.commit_sha,
+            started_at=time(),
+        )
+        self.status_listeners = []
+
+    def status_changed(self):
+        for listener in self.status_listeners:
+            listener(self.status)
 
     def load_foxfile(self, repo_root: Path):
-        file = repo_root / 'foxfile.yml'
+        file = repo_root / FOXFILE_NAME
         if not file.is_file():
             raise ConfigurationError('Foxfile not found')
-        try:
-            self.foxfile = Foxfile.model_validate(yaml.safe_load(file.read_text()))
-        except (YAMLError, ValidationError) as e:
-            raise ConfigurationError(str(e))
+        self.foxfile = parse_foxfile(file.read_text())
+
+    async def load_foxfile_from_mirror(self):
+        blob_hash = await get_blob_hash(self.run_info, FOXFILE_NAME)
+        if blob_hash is None:
+            raise ConfigurationError('Foxfile not found')
+        if (foxfile := _foxfile_cache.get(blob_hash)) is None:
+            foxfile = parse_foxfile(await read_blob(self.run_info, blob_hash))
+            _foxfile_cache[blob_hash] = foxfile
+            if len(_foxfile_cache) > FOXFILE_CACHE_SIZE:
+                _foxfile_cache.popitem(last=False)
+        else:
+            _foxfile_cache.move_to_end(blob_hash)
+        self.foxfile = foxfile
+
+    def _init_stage_statuses(self):
+        for i, (workflow_name, workflow) in enumerate(self.foxfile.workflows.items()):
+            for j, stage_name in enumerate(workflow.stages):
+                self.status.stages[f'{i}_{j}'] = StageStatus(
+                    workflow=workflow_name, stage=stage_name
+                )
 
     async def run(self) -> RunResult:
+        run_registry.start(self.status)
+        try:
+            return await self._run()
+        finally:
+            run_registry.finish(self.status, self.logs_dir)
+
+    async def _run(self) -> RunResult:
         if self.host_workdir:
-            self.load_foxfile(self.host_workdir)
+            with foxfile_load_seconds.time():
+                self.load_foxfile(self.host_workdir)
         else:
-            with TemporaryDirectory() as path:
-                await checkout_repo(self.run_info, path)
-                self.load_foxfile(Path(path))
+            await mirror_manager.ensure_commit(self.run_info)
+            async with mirror_manager.using(self.run_info):
+                with foxfile_load_seconds.time():
+                    await self.load_foxfile_from_mirror()
+            # workers check out their own base
+            if config.workspace_mode != WorkspaceMode.clone and not config.coordinator:
+                await ensure_base(self.run_info)
+        self._init_stage_statuses()
+        self.status_changed()
 
         results = {}
-        for i, (workflow_name, workflow) in enumerate(self.foxfile.workflows.items()):
-            workflow_runner = WorkflowRunner(self, workflow, i)
-            results[workflow_name] = await workflow_runner.run()
-        return RunResult(workflows=results)
+
+        async def run_workflow(workflow_name: str, workflow_runner: WorkflowRunner):
+            result = await workflow_runner.run()
+            results[workflow_name] = result
+            if self.foxfile.fail_fast and not result.is_ok:
+                raise FailFastAbort
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for i, (workflow_name, workflow) in enumerate(
+                    self.foxfile.workflows.items()
+                ):
+                    tg.create_task(
+                        run_workflow(workflow_name, WorkflowRunner(self, workflow, i))
+                    )
+        except* FailFastAbort:
+            pass
+        return RunResult(
+            workflows={name: results.get(name) for name in self.foxfile.workflows}
+        )
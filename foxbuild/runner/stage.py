@@ -1,37 +1,83 @@
+import asyncio
 import os.path
 import os.path
 from asyncio import create_subprocess_exec
+from asyncio.subprocess import Process
 
 import json
 import logging
 import re
 import shutil
-from hashlib import sha1
+import signal
+from contextlib import suppress
+from hashlib import sha1, sha256
 from pathlib import Path
 from subprocess import PIPE, DEVNULL
 from tempfile import TemporaryDirectory
+from time import perf_counter
 from typing import TYPE_CHECKING
 
-from foxbuild.config import config, OperationMode
+from foxbuild.config import config, WorkspaceMode
 from foxbuild.const import DEFAULT_IMAGE, SANDBOX_WORKDIR
-from foxbuild.runner.utils import checkout_repo
-from foxbuild.sandbox import Sandbox
+from foxbuild.image_store import image_store
+from foxbuild.metrics import (
+    env_resolve_seconds,
+    sandbox_start_seconds,
+    stage_cleanup_seconds,
+    stage_results_cached,
+    stage_run_seconds,
+)
+from foxbuild.runner.dir_cache import ARCHIVES, dir_cache, render_key, split_paths
+from foxbuild.runner.envs import env_resolver
+from foxbuild.runner.logs import OutputCapture, StageLog
+from foxbuild.runner.mirrors import mirror_manager
+from foxbuild.runner.nixpkgs import resolve_nixpkgs_rev
+from foxbuild.runner.profiles import profile_store
+from foxbuild.runner.result_cache import result_cache
+from foxbuild.runner.utils import get_tree_hash
+from foxbuild.runner.workspace import (
+    get_run_dir,
+    create_workspace,
+    release_workspace,
+)
+from foxbuild.sandbox import Sandbox, create_sandbox, sessions_enabled
+from foxbuild.sandbox_pool import sandbox_pool
 from foxbuild.schemas import StageResult
 from foxbuild.schemas.foxfile import StageDef, WorkflowDef, EnvSettings
-from foxbuild.utils import async_check_output, NIX, BASH, JQ
+from foxbuild.utils import async_check_output, NIX, BASH, JQ, CP
 
 if TYPE_CHECKING:
     from foxbuild.runner.runner import Runner
 
 logger = logging.getLogger(__name__)
 
+# $1 - archive, $2 - the dir it's relative to, home or workdir
+RESTORE_CACHE_SCRIPT = '''
+if [ "$2" = home ]; then base=$HOME; else base=$PWD; fi
+mkdir -p "$base" && exec tar --zstd -xf "$1" -C "$base"
+'''
+# $1 - archive, $2 - the dir the paths are relative to, the rest - paths
+SAVE_CACHE_SCRIPT = '''
+out=$1
+if [ "$2" = home ]; then cd "$HOME" || exit 0; fi
+shift 2
+paths=()
+for path in "$@"; do
+  if [ -e "$path" ]; then paths+=("$path"); fi
+done
+if [ ${#paths[@]} -ne 0 ]; then exec tar --zstd -cf "$out" -- "${paths[@]}"; fi
+'''
+
 
 class StageRunner:
     runner: 'Runner'
     workflow: WorkflowDef
     stage: StageDef
     host_workdir: Path
+    log_file: Path
     sandbox: Sandbox | None
+    _processes: list[Process]
+    _nixpkgs_rev: str | None
 
     def __init__(
         self,
@@ -41,19 +87,17 @@ class StageRunner:
         stage: StageDef,
     ):
         if runner.host_workdir is None:
-            self.host_workdir = (
-                config.runs_dir
-                / runner.run_info.provider
-                / runner.run_info.run_id
-                / workflow_stage_key
-            )
+            self.host_workdir = get_run_dir(runner.run_info) / workflow_stage_key
             self.host_workdir.mkdir(parents=True)
         else:
             self.host_workdir = runner.host_workdir
+        self.log_file = runner.logs_dir / f'{workflow_stage_key}.log'
         self.runner = runner
         self.workflow = workflow
         self.stage = stage
         self.sandbox = None
+        self._processes = []
+        self._nixpkgs_rev = None
 
     @property
     def env(self) -> EnvSettings:
@@ -82,71 +126,79 @@ class StageRunner:
         self, *args: str, stdout=None, stderr=None, env=None
     ):
         if self.use_sandbox:
-            cmd_workdir = config.empty_dir
-            self.sandbox.add_envs(env)
-            env = {}
-            prefix = self.sandbox.build_cmd_prefix()
+            p = await self.sandbox.exec(*args, env=env, stdout=stdout, stderr=stderr)
         else:
-            cmd_workdir = self.host_workdir
-            prefix = []
-        try:
-            return await create_subprocess_exec(
-                *prefix,
+            p = await create_subprocess_exec(
                 *args,
-                cwd=cmd_workdir,
+                cwd=self.host_workdir,
                 stdin=DEVNULL,
                 stdout=stdout,
                 stderr=stderr,
                 env=env,
+                start_new_session=True,
             )
-        finally:
-            if self.use_sandbox:
-                self.sandbox.clear_env()
+        self._processes.append(p)
+        return p
 
     async def check_maybe_sandboxed(self, *args: str) -> str:
         p = await self.exec_maybe_sandboxed(*args, stdout=PIPE, stderr=None)
+        # read before waiting, the process blocks once the pipe buffer is full
+        stdout = await p.stdout.read()
         await p.wait()
         if p.returncode:
             logger.error(f'Process exited with code {p.returncode}')
             raise ValueError
-        return (await p.stdout.read()).decode()
+        return stdout.decode()
 
-    def gen_nix_shell(self):
-        for package in self.env.packages:
+    async def get_nixpkgs_rev(self) -> str:
+        # resolved once, so the profile name and the shell agree on it
+        if self._nixpkgs_rev is None:
+            self._nixpkgs_rev = await resolve_nixpkgs_rev(self.env.nixpkgs)
+        return self._nixpkgs_rev
+
+    @property
+    def packages(self) -> list[str]:
+        return sorted(set(self.env.packages or ()))
+
+    def gen_nix_shell(self, nixpkgs_rev: str):
+        for package in self.packages:
             if not re.fullmatch(r'[a-zA-Z_][\w\-]+', package):
                 raise ValueError
-        packages = ' '.join(self.env.packages)
-        return '''
+        if not re.fullmatch(r'[0-9a-f]{40}', nixpkgs_rev):
+            raise ValueError
+        packages = ' '.join(self.packages)
+        return (
+            '''
             let 
-              pkgs = import (fetchTarball "https://github.com/NixOS/nixpkgs/archive/nixpkgs-unstable.tar.gz") {};
+              pkgs = import (fetchTarball "https://github.com/NixOS/nixpkgs/archive/__REV__.tar.gz") {};
             in
               pkgs.mkShell {
                 nativeBuildInputs = with pkgs; [__PACKAGES__];
               }
-        '''.replace(
-            '__PACKAGES__', packages
+        '''.replace('__REV__', nixpkgs_rev)
+            .replace('__PACKAGES__', packages)
         )
 
     async def get_shell_variables(self, profile_name: str | None):
+        start = perf_counter()
         if self.env.use_flake:
             cmd = [self.env.use_flake]
         else:
             cmd = [
                 '--impure',
                 '--expr',
-                self.gen_nix_shell(),
+                self.gen_nix_shell(await self.get_nixpkgs_rev()),
             ]
 
         if profile_name:
-            env_file = config.profiles_dir / (profile_name + '.rc')
-            if env_file.is_file():
-                return json.loads(env_file.read_text())
+            env_file = profile_store.rc_file(profile_name)
+            if (env := profile_store.read(profile_name)) is not None:
+                env_resolve_seconds.observe(perf_counter() - start, cache='hit')
+                return env
 
-        with TemporaryDirectory() as tempdir:
+        with self.make_scratch_dir() as tempdir:
             os.chmod(tempdir, 0o777)
             tmp_profile = os.path.join(tempdir, 'profile')
-            if self.use_sandbox:
-                self.sandbox.add_rw_bind(tempdir, tempdir)
             rc = await self.check_maybe_sandboxed(
                 NIX,
                 'print-dev-env',
@@ -154,15 +206,13 @@ class StageRunner:
                 tmp_profile,
                 *cmd,
             )
-            if self.use_sandbox:
-                self.sandbox.remove_rw_bind(tempdir, tempdir)
             if profile_name:
                 # Already built, will just be symlinked and added to gcroots. Can be run on host
                 await async_check_output(
                     NIX,
                     'build',
                     '--out-link',
-                    str(config.profiles_dir / profile_name),
+                    str(profile_store.gcroot(profile_name)),
                     tmp_profile,
                     cwd=config.empty_dir,
                 )
@@ -190,12 +240,26 @@ class StageRunner:
                 del env[var]
 
         if profile_name:
-            env_file.write_text(json.dumps(env))
+            # readers must never see a partially written file
+            tmp_file = env_file.with_name(env_file.name + '.tmp')
+            tmp_file.write_text(json.dumps(env))
+            tmp_file.replace(env_file)
+            await profile_store.add(profile_name)
 
+        env_resolve_seconds.observe(perf_counter() - start, cache='miss')
         return env
 
-    def get_profile_filename(self) -> str | None:
-        if self.runner.foxfile.nix_paths is None or self.env.use_flake is False:
+    async def get_profile_filename(self) -> str | None:
+        if not self.env.use_flake:
+            return await self.get_packages_profile_filename()
+        return self.get_flake_profile_filename()
+
+    async def get_packages_profile_filename(self) -> str:
+        key = f'{await self.get_nixpkgs_rev()}\n' + '\n'.join(self.packages)
+        return 'packages-' + sha1(key.encode()).hexdigest()
+
+    def get_flake_profile_filename(self) -> str | None:
+        if self.runner.foxfile.nix_paths is None:
             return None
         paths = []
         for entry in self.runner.foxfile.nix_paths:
@@ -218,21 +282,233 @@ class StageRunner:
             hashes.update(sha1(p.read_bytes()).digest())
         return hashes.hexdigest()
 
+    async def resolve_env(self) -> dict[str, str]:
+        profile_name = await self.get_profile_filename()
+        if profile_name:
+            # profiles are content-addressed, so this is shared between runs
+            key = profile_name
+        else:
+            env = self.env
+            key = (
+                self.runner,
+                env.use_flake,
+                tuple(self.packages),
+                env.nixpkgs,
+                env.image,
+            )
+        return await env_resolver.resolve(
+            key, lambda: self.get_shell_variables(profile_name)
+        )
+
+    async def get_result_cache_key(self) -> str | None:
+        # only commits are content-addressed, a local workdir may have changes
+        run_info = self.runner.run_info
+        if run_info is None or not self.stage.cache_result:
+            return None
+        env = self.env
+        key = sha256()
+        async with mirror_manager.using(run_info):
+            key.update((await get_tree_hash(run_info, self.stage.inputs)).encode())
+            if env.use_flake:
+                # the dev environment may depend on files outside of the inputs
+                nix_paths = self.runner.foxfile.nix_paths
+                key.update((await get_tree_hash(run_info, nix_paths or [])).encode())
+        key.update(self.stage.model_dump_json().encode())
+        key.update(json.dumps([env.image, env.use_flake]).encode())
+        if not env.use_flake:
+            key.update((await self.get_packages_profile_filename()).encode())
+        return key.hexdigest()
+
+    def get_dir_cache_namespace(self, branch: str | None) -> str:
+        # caches are never shared between repositories or images
+        if run_info := self.runner.run_info:
+            return f'{run_info.provider}/{run_info.repo_name}/{self.env.image}/{branch}'
+        return f'local/{self.runner.host_workdir}/{self.env.image}'
+
+    @property
+    def dir_cache_namespaces(self) -> tuple[str | None, list[str]]:
+        # (saved to, restored from). Other branches and pull requests fall
+        # back to caches of the default branch but never write them, forks
+        # only read those
+        run_info = self.runner.run_info
+        if run_info is None:
+            namespace = self.get_dir_cache_namespace(None)
+            return namespace, [namespace]
+        own = run_info.branch and self.get_dir_cache_namespace(run_info.branch)
+        read = [own] if own else []
+        if run_info.default_branch and run_info.default_branch != run_info.branch:
+            read.append(self.get_dir_cache_namespace(run_info.default_branch))
+        return own, read
+
+    @property
+    def dir_cache_archives(self) -> tuple[str, ...]:
+        # HOME of an unsandboxed stage is the one of the host user
+        if self.use_sandbox:
+            return ARCHIVES
+        return tuple(x for x in ARCHIVES if x != 'home')
+
+    def make_scratch_dir(self) -> TemporaryDirectory:
+        # the scratch dir is visible at the same path inside the sandbox
+        return TemporaryDirectory(
+            dir=self.sandbox.scratch_dir if self.use_sandbox else None
+        )
+
+    async def restore_dir_cache(self, key: str) -> bool:
+        # returns whether it was an exact hit
+        _, read_namespaces = self.dir_cache_namespaces
+        for read_namespace in read_namespaces:
+            found = dir_cache.find(read_namespace, key, self.stage.cache.restore_keys)
+            if found is not None:
+                break
+        else:
+            return False
+        name, found_key = found
+        dir_cache.touch(name)
+        with self.make_scratch_dir() as tempdir:
+            os.chmod(tempdir, 0o777)
+            for archive_name in self.dir_cache_archives:
+                archive = dir_cache.entry_dir(name) / f'{archive_name}.tar.zst'
+                if not archive.is_file():
+                    continue
+                local_archive = os.path.join(tempdir, archive.name)
+                await async_check_output(
+                    CP, '--reflink=auto', archive, local_archive, cwd=config.empty_dir
+                )
+                await self.check_maybe_sandboxed(
+                    BASH, '-c', RESTORE_CACHE_SCRIPT, 'bash', local_archive, archive_name
+                )
+        logger.info(f'Restored cache {found_key!r} from {read_namespace}')
+        return found_key == key
+
+    async def save_dir_cache(self, key: str):
+        namespace, _ = self.dir_cache_namespaces
+        if namespace is None:
+            return
+        with self.make_scratch_dir() as tempdir:
+            os.chmod(tempdir, 0o777)
+            snapshot = Path(tempdir) / 'snapshot'
+            snapshot.mkdir()
+            os.chmod(snapshot, 0o777)
+            for archive_name, paths in split_paths(self.stage.cache.paths).items():
+                if paths and archive_name in self.dir_cache_archives:
+                    await self.check_maybe_sandboxed(
+                        BASH,
+                        '-c',
+                        SAVE_CACHE_SCRIPT,
+                        'bash',
+                        str(snapshot / f'{archive_name}.tar.zst'),
+                        archive_name,
+                        *paths,
+                    )
+            if any(snapshot.iterdir()):
+                await dir_cache.store(namespace, key, snapshot)
+                logger.info(f'Saved cache {key!r}')
+
+    async def start_sandbox(self):
+        start = perf_counter()
+        resources = self.stage.resources
+        # pooled sandboxes are started without limits
+        if not resources:
+            self.sandbox = await sandbox_pool.claim(self.env.image, self.host_workdir)
+            if self.sandbox:
+                sandbox_start_seconds.observe(perf_counter() - start, pooled='true')
+                return
+        self.sandbox = create_sandbox(
+            overlay_nix_cache=True,
+            workdir=SANDBOX_WORKDIR,
+            image=self.env.image,
+        )
+        self.sandbox.add_rw_bind(str(self.host_workdir), SANDBOX_WORKDIR)
+        if resources:
+            self.sandbox.set_resources(resources.cpus, resources.memory)
+        if sessions_enabled():
+            await self.sandbox.start_session()
+        sandbox_start_seconds.observe(perf_counter() - start, pooled='false')
+
     async def run(self) -> StageResult:
+        cache_key = await self.get_result_cache_key()
+        # a rerun still refreshes the cached result
+        if (
+            cache_key
+            and not self.runner.run_info.rerun
+            and (result := result_cache.get(cache_key, self.log_file))
+        ):
+            logger.info(f'Reusing a cached result for stage {self.log_file.stem}')
+            stage_results_cached.inc()
+            self.host_workdir.rmdir()
+            return result
+
+        env_task = None
+        images_task = None
+        # an overlay workspace is a mount, it must exist before a sandbox binds it
+        workspace_first = config.workspace_mode == WorkspaceMode.overlay
         try:
-            if self.runner.run_info:
-                await checkout_repo(self.runner.run_info, self.host_workdir)
+            nested_images = self.stage.nested_images
+            if self.use_sandbox and config.nested_image_store and nested_images:
+                images_task = asyncio.create_task(image_store.ensure(nested_images))
+
+            if self.runner.run_info and workspace_first:
+                await create_workspace(self.runner.run_info, self.host_workdir)
 
             if self.use_sandbox:
-                self.sandbox = Sandbox(
-                    overlay_nix_cache=True,
-                    workdir=SANDBOX_WORKDIR,
-                    image=self.env.image,
+                await self.start_sandbox()
+
+            if not self.env.use_flake:
+                # doesn't depend on the repository, resolve while it's checked out
+                env_task = asyncio.create_task(self.resolve_env())
+
+            if self.runner.run_info and not workspace_first:
+                await create_workspace(self.runner.run_info, self.host_workdir)
+
+            env = await (env_task or self.resolve_env())
+
+            dir_cache_key = None
+            dir_cache_hit = False
+            if self.stage.cache:
+                dir_cache_key = await render_key(
+                    self.stage.cache.key, self.host_workdir
                 )
-                self.sandbox.add_rw_bind(str(self.host_workdir), SANDBOX_WORKDIR)
+                if 'home' not in self.dir_cache_archives and any(
+                    x.startswith('~/') for x in self.stage.cache.paths
+                ):
+                    logger.warning('Not caching ~/ paths of an unsandboxed stage')
+                try:
+                    dir_cache_hit = await self.restore_dir_cache(dir_cache_key)
+                except ValueError:
+                    logger.warning(f'Failed to restore cache {dir_cache_key!r}')
+
+            if images_task:
+                try:
+                    await images_task
+                except ValueError:
+                    # podman in the sandbox will pull them itself
+                    logger.warning('Failed to pull images into the shared store')
 
-            env = await self.get_shell_variables(self.get_profile_filename())
+            result = await self.run_script(env)
+            if dir_cache_key and not dir_cache_hit and result.exit_code == 0:
+                try:
+                    await self.save_dir_cache(dir_cache_key)
+                except ValueError:
+                    logger.warning(f'Failed to save cache {dir_cache_key!r}')
+            if cache_key and result.exit_code == 0:
+                result_cache.put(cache_key, result)
+            return result
+        except asyncio.CancelledError:
+            await self.kill()
+            raise
+        finally:
+            for task in (env_task, images_task):
+                if task and not task.done():
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+            await self.cleanup()
 
+    async def run_script(self, env: dict[str, str]) -> StageResult:
+        stdout = OutputCapture(config.stage_output_head, config.stage_output_tail)
+        stderr = OutputCapture(config.stage_output_head, config.stage_output_tail)
+        log = StageLog(self.log_file)
+        start = perf_counter()
+        try:
             p = await self.exec_maybe_sandboxed(
                 BASH,
                 '-c',
@@ -241,37 +517,38 @@ class StageRunner:
                 stdout=PIPE,
                 stderr=PIPE,
             )
-            await p.wait()
-
-            return StageResult(
-                exit_code=p.returncode,
-                stdout=(await p.stdout.read()).decode(),
-                stderr=(await p.stderr.read()).decode(),
+            await asyncio.gather(
+                log.drain('out', p.stdout, stdout),
+                log.drain('err', p.stderr, stderr),
             )
+            await p.wait()
         finally:
-            await self.cleanup()
+            log.close()
 
-    async def _remove_workdir_if_needed(self):
-        if config.mode == OperationMode.standalone:
-            effective_workdir = (
-                SANDBOX_WORKDIR if self.use_sandbox else self.host_workdir
-            )
-            dirs = (
-                x.relative_to(self.host_workdir) for x in self.host_workdir.glob('*')
-            )
-            dirs = (os.path.join(effective_workdir, x) for x in dirs)
-            self.sandbox.clear_env()
-            try:
-                self.sandbox.unsafe_run_as_root = True
-                await self.check_maybe_sandboxed(
-                    'rm',
-                    '-rf',
-                    *dirs,
-                )
-            finally:
-                self.sandbox.unsafe_run_as_root = False
-            self.host_workdir.rmdir()
+        stage_run_seconds.observe(
+            perf_counter() - start,
+            result='success' if p.returncode == 0 else 'failure',
+        )
+        return StageResult(
+            exit_code=p.returncode,
+            stdout=stdout.text(),
+            stderr=stderr.text(),
+            truncated=stdout.truncated or stderr.truncated,
+            log_file=str(self.log_file),
+        )
+
+    async def kill(self):
+        for p in self._processes:
+            # processes of the api backend live in the container, removed below
+            if isinstance(p, Process) and p.returncode is None:
+                with suppress(ProcessLookupError):
+                    os.killpg(p.pid, signal.SIGKILL)
+        if self.sandbox:
+            await self.sandbox.kill()
 
     async def cleanup(self):
-        if self.use_sandbox:
-            await self.sandbox.cleanup()
+        with stage_cleanup_seconds.time():
+            if self.sandbox:
+                await self.sandbox.cleanup()
+            if self.runner.run_info:
+                await release_workspace(self.host_workdir)
@@ -0,0 +1,61 @@
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from time import time
+
+from foxbuild.config import config
+from foxbuild.schemas import RunStatus, StageState
+
+logger = logging.getLogger(__name__)
+
+STATUS_FILE = 'status.json'
+FINISHED_RUNS_KEPT = 256
+
+
+class RunRegistry:
+    # Statuses of runs of this process. Finished ones are also written next
+    # to their logs, so they can be looked up after they're dropped here
+    _active: dict[tuple[str, str], RunStatus]
+    _finished: OrderedDict[tuple[str, str], RunStatus]
+
+    def __init__(self):
+        self._active = {}
+        self._finished = OrderedDict()
+
+    def start(self, status: RunStatus):
+        self._active[status.provider, status.run_id] = status
+
+    def finish(self, status: RunStatus, logs_dir: Path):
+        key = status.provider, status.run_id
+        status.finished = True
+        status.finished_at = time()
+        for stage in status.stages.values():
+            if stage.is_active:
+                stage.state = StageState.cancelled
+        self._active.pop(key, None)
+        self._finished[key] = status
+        if len(self._finished) > FINISHED_RUNS_KEPT:
+            self._finished.popitem(last=False)
+        try:
+            logs_dir.mkdir(parents=True, exist_ok=True)
+            (logs_dir / STATUS_FILE).write_text(status.model_dump_json())
+        except OSError:
+            logger.exception('Failed to save the run status')
+
+    def is_active(self, provider: str, run_id: str) -> bool:
+        key = provider, run_id
+        return key in self._active
+
+    def get(self, provider: str, run_id: str) -> RunStatus | None:
+        key = provider, run_id
+        if status := self._active.get(key) or self._finished.get(key):
+            return status
+        file = config.logs_dir / provider / run_id / STATUS_FILE
+        if file.is_file():
+            return RunStatus.model_validate_json(file.read_text())
+        return None
+
+
+run_registry = RunRegistry()
+
+__all__ = ['RunRegistry', 'run_registry']
@@ -1,4 +1,5 @@
 import asyncio
+import fnmatch
 import os.path
 from asyncio import create_subprocess_exec
 
@@ -7,7 +8,7 @@ import logging
 import re
 import shutil
 import yaml
-from hashlib import sha1
+from hashlib import sha1, sha256
 from pathlib import Path
 from pydantic import ValidationError
 from subprocess import PIPE, DEVNULL
@@ -20,17 +21,27 @@ from foxbuild.exceptions import ConfigurationError
 from foxbuild.sandbox import Sandbox
 from foxbuild.schemas import StageResult, StandaloneRunInfo, WorkflowResult, RunResult
 from foxbuild.schemas.foxfile import Foxfile, StageDef, WorkflowDef, EnvSettings
-from foxbuild.utils import async_check_output, NIX, BASH, JQ, GIT
+from foxbuild.utils import async_check_output, async_call, NIX, BASH, JQ, GIT
 
 
-async def checkout_repo(run_info: StandaloneRunInfo, at: str | Path):
-    repo_path = config.repos_dir / run_info.provider / run_info.repo_name
-    if repo_path.is_dir():
-        await async_check_output(
-            GIT, 'remote', 'set-url', 'origin', run_info.clone_url, cwd=repo_path
-        )
-        await async_check_output(GIT, 'fetch', cwd=repo_path)
-    else:
+class FailFastAbort(Exception):
+    pass
+
+
+def get_mirror_path(run_info: StandaloneRunInfo) -> Path:
+    return config.repos_dir / run_info.provider / run_info.repo_name
+
+
+async def has_commit(repo_path: Path, sha: str) -> bool:
+    return not await async_call(
+        GIT, 'cat-file', '-e', f'{sha}^{{commit}}', cwd=repo_path
+    )
+
+
+async def fetch_commit(run_info: StandaloneRunInfo) -> Path:
+    repo_path = get_mirror_path(run_info)
+    sha = run_info.commit_sha
+    if not repo_path.is_dir():
         repo_path.mkdir(parents=True)
         await async_check_output(
             GIT,
@@ -40,10 +51,36 @@ async def checkout_repo(run_info: StandaloneRunInfo, at: str | Path):
             '.',
             cwd=repo_path,
         )
+    elif await has_commit(repo_path, sha):
+        return repo_path
+    else:
+        # the token in clone_url changes between runs
+        await async_check_output(
+            GIT, 'remote', 'set-url', 'origin', run_info.clone_url, cwd=repo_path
+        )
+        # keep a ref to the commit, so it's reachable for local clones and gc
+        code = await async_call(
+            GIT,
+            'fetch',
+            'origin',
+            f'+{sha}:refs/foxbuild/commits/{sha}',
+            cwd=repo_path,
+        )
+        if code:
+            # the server doesn't allow fetching by sha
+            await async_check_output(GIT, 'fetch', 'origin', cwd=repo_path)
+    if not await has_commit(repo_path, sha):
+        raise ValueError(f'Commit {sha} not found in {run_info.repo_name}')
+    return repo_path
+
+
+async def checkout_commit(run_info: StandaloneRunInfo, at: str | Path):
+    # local clone from the mirror, hardlinks objects and doesn't touch the network
     await async_check_output(
         GIT,
         'clone',
-        repo_path,
+        '--no-checkout',
+        get_mirror_path(run_info),
         '.',
         cwd=at,
     )
@@ -54,3 +91,52 @@ async def checkout_repo(run_info: StandaloneRunInfo, at: str | Path):
         run_info.commit_sha,
         cwd=at,
     )
+
+
+async def get_blob_hash(run_info: StandaloneRunInfo, path: str) -> str | None:
+    out = await async_check_output(
+        GIT, 'ls-tree', run_info.commit_sha, '--', path, cwd=get_mirror_path(run_info)
+    )
+    if not out:
+        return None
+    mode_type_hash, _ = out.split('\t', 1)
+    _, obj_type, obj_hash = mode_type_hash.split()
+    if obj_type != 'blob':
+        return None
+    return obj_hash
+
+
+async def read_blob(run_info: StandaloneRunInfo, obj_hash: str) -> str:
+    return await async_check_output(
+        GIT, 'cat-file', 'blob', obj_hash, cwd=get_mirror_path(run_info)
+    )
+
+
+def _matches_path(path: str, pattern: str) -> bool:
+    pattern = pattern.strip('/')
+    return (
+        path == pattern
+        or path.startswith(pattern + '/')
+        or fnmatch.fnmatchcase(path, pattern)
+    )
+
+
+async def get_tree_hash(run_info: StandaloneRunInfo, paths: list[str] | None) -> str:
+    # hash of the commit tree, or only of the files under paths
+    repo_path = get_mirror_path(run_info)
+    if paths is None:
+        out = await async_check_output(
+            GIT, 'rev-parse', f'{run_info.commit_sha}^{{tree}}', cwd=repo_path
+        )
+        return out.strip()
+    out = await async_check_output(
+        GIT, 'ls-tree', '-r', '-z', run_info.commit_sha, cwd=repo_path
+    )
+    res = sha256()
+    for entry in out.split('\0'):
+        if not entry:
+            continue
+        _, path = entry.split('\t', 1)
+        if any(_matches_path(path, pattern) for pattern in paths):
+            res.update(entry.encode() + b'\0')
+    return res.hexdigest()
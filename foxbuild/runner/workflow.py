@@ -1,7 +1,14 @@
+import asyncio
+from contextlib import nullcontext
+from time import time
 from typing import TYPE_CHECKING
 
+from foxbuild.config import config
+from foxbuild.coordinator import RemoteStageRunner
+from foxbuild.runner.budget import stage_budget
 from foxbuild.runner.stage import StageRunner
-from foxbuild.schemas import WorkflowResult
+from foxbuild.runner.utils import FailFastAbort
+from foxbuild.schemas import WorkflowResult, StageResult, StageState
 from foxbuild.schemas.foxfile import WorkflowDef
 
 if TYPE_CHECKING:
@@ -12,19 +19,86 @@ class WorkflowRunner:
     runner: 'Runner'
     workflow: WorkflowDef
     workflow_idx: int
+    _results: dict[str, StageResult | None]
+    _finished: dict[str, asyncio.Event]
 
     def __init__(self, runner: 'Runner', workflow: WorkflowDef, workflow_idx: int):
         self.runner = runner
         self.workflow = workflow
         self.workflow_idx = workflow_idx
+        self._results = {}
+        self._finished = {}
+
+    def _needs_succeeded(self, stage_name: str) -> bool:
+        for dep in self.runner.foxfile.stages[stage_name].needs or ():
+            result = self._results.get(dep)
+            if result is None or result.exit_code != 0:
+                return False
+        return True
+
+    async def _run_stage(self, i: int, stage_name: str):
+        stage = self.runner.foxfile.stages[stage_name]
+        key = f'{self.workflow_idx}_{i}'
+        status = self.runner.status.stages[key]
+        try:
+            for dep in stage.needs or ():
+                await self._finished[dep].wait()
+            if not self._needs_succeeded(stage_name):
+                # skipped stages are reported as None
+                self._results[stage_name] = None
+                status.state = StageState.skipped
+                self.runner.status_changed()
+                return
+            resources = stage.resources
+            if config.coordinator:
+                # workers do their own admission control
+                slot = nullcontext()
+            else:
+                slot = stage_budget.slot(
+                    self.runner,
+                    resources and resources.cpus,
+                    resources and resources.memory,
+                )
+            async with slot:
+                if config.coordinator:
+                    workflow_name = list(self.runner.foxfile.workflows)[
+                        self.workflow_idx
+                    ]
+                    stage_runner = RemoteStageRunner(
+                        key, self.runner, workflow_name, stage_name
+                    )
+                else:
+                    stage_runner = StageRunner(key, self.runner, self.workflow, stage)
+                status.state = StageState.running
+                status.started_at = time()
+                self.runner.status_changed()
+                result = await stage_runner.run()
+            self._results[stage_name] = result
+            status.state = StageState.finished
+            status.exit_code = result.exit_code
+            status.finished_at = time()
+            self.runner.status_changed()
+            if result.exit_code != 0 and (
+                self.workflow.fail_fast or self.runner.foxfile.fail_fast
+            ):
+                raise FailFastAbort
+        finally:
+            if status.is_active:
+                status.state = StageState.cancelled
+                status.finished_at = time()
+                self.runner.status_changed()
+            self._finished[stage_name].set()
 
     async def run(self) -> WorkflowResult:
-        results = {}
-        for i, stage_name in enumerate(self.workflow.stages):
-            stage = self.runner.foxfile.stages[stage_name]
-            workflow_stage_key = f'{self.workflow_idx}_{i}'
-            stage_runner = StageRunner(
-                workflow_stage_key, self.runner, self.workflow, stage
-            )
-            results[stage_name] = await stage_runner.run()
-        return WorkflowResult(stages=results)
+        self._results = {}
+        self._finished = {name: asyncio.Event() for name in self.workflow.stages}
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for i, stage_name in enumerate(self.workflow.stages):
+                    tg.create_task(self._run_stage(i, stage_name))
+        except* FailFastAbort:
+            # siblings of the failed stage were cancelled and are reported as None
+            pass
+        return WorkflowResult(
+            stages={name: self._results.get(name) for name in self.workflow.stages}
+        )
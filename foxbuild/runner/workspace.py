@@ -0,0 +1,163 @@
+import asyncio
+import fcntl
+import logging
+import os
+import shutil
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import IO
+
+from foxbuild.config import config, WorkspaceMode
+from foxbuild.metrics import checkout_seconds
+from foxbuild.runner.mirrors import mirror_manager
+from foxbuild.runner.utils import checkout_commit
+from foxbuild.schemas import StandaloneRunInfo
+from foxbuild.utils import async_check_output, async_flock, MOUNT, UMOUNT, CP
+
+logger = logging.getLogger(__name__)
+
+RUN_LOCK_FILE = 'run.lock'
+
+
+def get_run_dir(run_info: StandaloneRunInfo) -> Path:
+    return config.runs_dir / run_info.provider / run_info.run_id
+
+
+def get_base_dir(run_info: StandaloneRunInfo) -> Path:
+    return get_run_dir(run_info) / 'base'
+
+
+def _is_same_file(f: IO, path: Path) -> bool:
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), path.stat())
+    except FileNotFoundError:
+        return False
+
+
+@asynccontextmanager
+async def hold_run(run_info: StandaloneRunInfo):
+    # shared lock of the run dir while stages of the run use it. The janitor
+    # of every process on the host skips run dirs it can't lock exclusively
+    run_dir = get_run_dir(run_info)
+    lock_file = run_dir / RUN_LOCK_FILE
+    while True:
+        run_dir.mkdir(parents=True, exist_ok=True)
+        f = open(lock_file, 'a')
+        try:
+            await async_flock(f, fcntl.LOCK_SH)
+            # or the janitor removed the run dir while this waited
+            if _is_same_file(f, lock_file):
+                break
+        except BaseException:
+            f.close()
+            raise
+        f.close()
+    with f:
+        yield
+
+
+def try_lock_run_dir(run_dir: Path) -> IO | None:
+    # exclusive lock of a run dir no stage uses, until the file is closed
+    try:
+        f = open(run_dir / RUN_LOCK_FILE, 'a')
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def _overlay_dirs(workspace: Path) -> tuple[Path, Path]:
+    cow_dir = workspace.with_name(workspace.name + '.cow')
+    return cow_dir / 'upper', cow_dir / 'work'
+
+
+async def ensure_base(run_info: StandaloneRunInfo):
+    # the base tree is never bound into a sandbox, only copied or used as
+    # an overlay lower dir, so stages can't modify it. Worker processes on
+    # one host check it out once per run, under base.lock. It's checked out
+    # next to its place and only moved there when complete
+    base_dir = get_base_dir(run_info)
+    if base_dir.is_dir():
+        return
+    base_dir.parent.mkdir(parents=True, exist_ok=True)
+    with open(base_dir.with_name('base.lock'), 'a') as lock:
+        await async_flock(lock, fcntl.LOCK_EX)
+        if base_dir.is_dir():
+            return
+        tmp_dir = base_dir.with_name('base.tmp')
+        # left by a process that was killed
+        await asyncio.to_thread(shutil.rmtree, tmp_dir, True)
+        tmp_dir.mkdir()
+        try:
+            async with mirror_manager.using(run_info):
+                with checkout_seconds.time(mode='base'):
+                    await checkout_commit(run_info, tmp_dir)
+            tmp_dir.rename(base_dir)
+        except BaseException:
+            await asyncio.shield(asyncio.to_thread(shutil.rmtree, tmp_dir, True))
+            raise
+
+
+async def create_workspace(run_info: StandaloneRunInfo, workspace: Path):
+    mode = config.workspace_mode
+    with checkout_seconds.time(mode=mode.value):
+        await _create_workspace(run_info, workspace, mode)
+
+
+async def _create_workspace(
+    run_info: StandaloneRunInfo, workspace: Path, mode: WorkspaceMode
+):
+    if mode == WorkspaceMode.clone:
+        async with mirror_manager.using(run_info):
+            await checkout_commit(run_info, workspace)
+    elif mode == WorkspaceMode.reflink:
+        await async_check_output(
+            CP,
+            '-a',
+            '--reflink=always',
+            f'{get_base_dir(run_info)}/.',
+            str(workspace),
+            cwd=config.empty_dir,
+        )
+    elif mode == WorkspaceMode.overlay:
+        upper, work = _overlay_dirs(workspace)
+        upper.mkdir(parents=True)
+        work.mkdir()
+        await async_check_output(
+            MOUNT,
+            '-t',
+            'overlay',
+            'overlay',
+            '-o',
+            f'lowerdir={get_base_dir(run_info)},upperdir={upper},workdir={work}',
+            str(workspace),
+            cwd=config.empty_dir,
+        )
+    else:
+        raise ValueError(f'Unknown workspace mode {mode}')
+
+
+async def release_workspace(workspace: Path):
+    if config.workspace_mode != WorkspaceMode.overlay:
+        return
+    upper, work = _overlay_dirs(workspace)
+    if not upper.is_dir():
+        return
+    if workspace.is_mount():
+        await async_check_output(UMOUNT, str(workspace), cwd=config.empty_dir)
+    # the upper dir holds the stage's changes and is removed with the run dir
+    shutil.rmtree(work, ignore_errors=True)
+
+
+__all__ = [
+    'get_run_dir',
+    'hold_run',
+    'try_lock_run_dir',
+    'ensure_base',
+    'create_workspace',
+    'release_workspace',
+]
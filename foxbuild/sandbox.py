@@ -1,5 +1,9 @@
+import asyncio
 import os
 import tempfile
+import uuid
+from asyncio import create_subprocess_exec
+from subprocess import DEVNULL
 
 import shutil
 
@@ -8,19 +12,24 @@ import logging
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
-from foxbuild.config import config
-from foxbuild.const import SANDBOX_HOME
-from foxbuild.utils import PODMAN, async_check_output
+from foxbuild.config import config, SandboxBackend
+from foxbuild.const import SANDBOX_HOME, SANDBOX_IMAGE_STORE, SANDBOX_STORAGE_CONF
+from foxbuild.image_store import image_store
+from foxbuild.utils import PODMAN, MOUNT, UMOUNT, RM, async_check_output, async_call
 
 logger = logging.getLogger(__name__)
 
 
 class Sandbox:
+    PODMAN_SOCKET = '/run/podman/podman.sock'
+    PODMAN_URL = f'--url=unix://{PODMAN_SOCKET}'
     FORCE_ENV = {
         'HOME': SANDBOX_HOME,
         'NIX_REMOTE': 'daemon',
     }
     KEEP_PERMS = ['/tmp']
+    READY_MARKER = '/tmp/.foxbuild-ready'
+    SESSION_START_TIMEOUT = 60
 
     _ro_binds: list[tuple[str, str]]
     _rw_binds: list[tuple[str, str]]
@@ -31,8 +40,15 @@ class Sandbox:
     _do_overlay: bool
     _tmpfses: list[str]
     _other_args: list[str]
+    _cpus: float | None
+    _memory: int | None
     unsafe_run_as_root: bool
     _container_tmp: Path
+    scratch_dir: Path
+    id: str
+    session: str | None
+    _slot: tuple[Path, str] | None
+    _slot_attached: bool
 
     _is_shutdown: bool
 
@@ -48,6 +64,10 @@ class Sandbox:
             raise ValueError
 
         self._is_shutdown = False
+        self.id = uuid.uuid4().hex
+        self.session = None
+        self._slot = None
+        self._slot_attached = False
 
         global_profile = str(config.global_profile_dir)
         self._ro_binds = [
@@ -57,8 +77,20 @@ class Sandbox:
             (f'{global_profile}/bin/sh', '/bin/sh'),
             (f'{global_profile}/bin/env', '/usr/bin/env'),
         ]
+        if config.nested_image_store:
+            self._ro_binds += [
+                (str(image_store.storage_dir), SANDBOX_IMAGE_STORE),
+                (str(image_store.storage_conf), SANDBOX_STORAGE_CONF),
+            ]
+        # writable layer of podman in the sandbox
         self._container_tmp = Path(tempfile.mkdtemp())
-        self._rw_binds = [(self._container_tmp, f'{SANDBOX_HOME}/.local/share/containers')]
+        # host dir available at the same path inside the sandbox
+        self.scratch_dir = Path(tempfile.mkdtemp())
+        os.chmod(self.scratch_dir, 0o777)
+        self._rw_binds = [
+            (self._container_tmp, f'{SANDBOX_HOME}/.local/share/containers'),
+            (self.scratch_dir, self.scratch_dir),
+        ]
         self.clear_env()
         self._uid = 1000
         self._gid = 100
@@ -67,12 +99,16 @@ class Sandbox:
         self._tmpfses = ['/tmp', '/var/tmp', '/dev/shm', '/run/user/1000']
         self._image = image or 'empty'
         self.unsafe_run_as_root = False
+        self._cpus = None
+        self._memory = None
 
         self._other_args = [
-            '--url=unix:///run/podman/podman.sock',
+            self.PODMAN_URL,
             'run',
             '--rm',
             '--cap-add=SYS_ADMIN',
+            '--label',
+            f'foxbuild.sandbox={self.id}',
         ]
 
         NIX_CACHE_BIND = (str(config.nix_cache_dir), f'{SANDBOX_HOME}/.cache/nix')
@@ -83,16 +119,64 @@ class Sandbox:
             self._rw_binds.append(NIX_CACHE_BIND)
 
     def add_rw_bind(self, src: str, dst: str):
+        if self.session:
+            raise ValueError('Binds of a started session can\'t be changed')
         self._rw_binds.append((src, dst))
 
     def remove_rw_bind(self, src: str, dst: str):
+        if self.session:
+            raise ValueError('Binds of a started session can\'t be changed')
         self._rw_binds.remove((src, dst))
 
+    def set_resources(self, cpus: float | None, memory: int | None):
+        if self.session:
+            raise ValueError('Limits of a started session can\'t be changed')
+        self._cpus = cpus
+        self._memory = memory
+
+    async def add_slot(self, dst: str):
+        # A host dir that's made a shared mount point and bound with rslave
+        # propagation, so a directory can be bind mounted into an already
+        # started session with attach(). Requires root on the host
+        if self.session:
+            raise ValueError('Binds of a started session can\'t be changed')
+        slot_dir = Path(tempfile.mkdtemp())
+        await async_check_output(
+            MOUNT, '--bind', str(slot_dir), str(slot_dir), cwd=config.empty_dir
+        )
+        await async_check_output(
+            MOUNT, '--make-shared', str(slot_dir), cwd=config.empty_dir
+        )
+        self._slot = (slot_dir, dst)
+
+    async def attach(self, src: str | Path):
+        if self._slot is None:
+            raise ValueError('Sandbox has no slot')
+        if self._slot_attached:
+            raise ValueError('Slot is already attached')
+        await async_check_output(
+            MOUNT, '--bind', str(src), str(self._slot[0]), cwd=config.empty_dir
+        )
+        self._slot_attached = True
+
+    async def _remove_slot(self):
+        if self._slot is None:
+            return
+        slot_dir, _ = self._slot
+        if self._slot_attached:
+            await async_check_output(UMOUNT, str(slot_dir), cwd=config.empty_dir)
+            self._slot_attached = False
+        await async_check_output(UMOUNT, str(slot_dir), cwd=config.empty_dir)
+        slot_dir.rmdir()
+        self._slot = None
+
     def clear_env(self):
         self._env = self.FORCE_ENV.copy()
         self._env |= {
             'PATH': '/bin:/profile/bin',
         }
+        if config.nested_image_store:
+            self._env['CONTAINERS_STORAGE_CONF'] = SANDBOX_STORAGE_CONF
 
     def add_envs(self, envs: dict[str, str]):
         for k, v in envs.items():
@@ -101,41 +185,234 @@ class Sandbox:
             elif k not in self.FORCE_ENV:
                 self._env[k] = v
 
-    def build_cmd_prefix(self) -> list[str]:
-        if self._is_shutdown:
-            raise ValueError('Sandbox is shut down')
-        res = [PODMAN, *self._other_args]
+    def _build_run_args(self) -> list[str]:
+        res = [*self._other_args]
         for tmpfs in self._tmpfses:
             res.extend(('--mount', f'type=tmpfs,destination={tmpfs}'))
         if self._workdir:
             res.extend(('-w', self._workdir))
+        if self._cpus:
+            res.append(f'--cpus={self._cpus}')
+        if self._memory:
+            res.append(f'--memory={self._memory}')
         for src, dst in self._ro_binds:
             res.extend(('-v', f'{src}:{dst}:ro'))
         for src, dst in self._rw_binds:
             res.extend(('-v', f'{src}:{dst}'))
+        if self._slot:
+            res.extend(('-v', f'{self._slot[0]}:{self._slot[1]}:rslave'))
         for k, v in self._env.items():
             res.extend(('-e', f'{k}={v}'))
-
         res.append(self._image)
-        if not self.unsafe_run_as_root:
-            res.extend(
-                ('bwrap-wrapper', str(self._uid), str(self._gid), str(self._do_overlay))
-            )
+        return res
+
+    def _build_wrapper_args(self) -> list[str]:
+        return ['bwrap-wrapper', str(self._uid), str(self._gid), str(self._do_overlay)]
+
+    def _build_exec_prefix(self) -> list[str]:
+        res = [PODMAN, self.PODMAN_URL, 'exec']
+        if self._workdir:
+            res.extend(('-w', self._workdir))
+        for k, v in self._env.items():
+            res.extend(('-e', f'{k}={v}'))
+        res.append(self.session)
+        res.extend(self._build_session_user_args())
+        return res
+
+    def _build_session_user_args(self) -> list[str]:
+        if self.unsafe_run_as_root:
+            return []
+        # same as the end of bwrap-wrapper, which has already set up
+        # the user and the nix cache overlay when the session started
+        return [
+            'capsh',
+            '--drop=CAP_SYS_ADMIN',
+            f'--gid={self._gid}',
+            f'--uid={self._uid}',
+            '--caps=',
+            '--shell=/usr/bin/env',
+            '--',
+            '--',
+        ]
+
+    def build_cmd_prefix(self) -> list[str]:
+        if self._is_shutdown:
+            raise ValueError('Sandbox is shut down')
+        if self.session:
+            res = self._build_exec_prefix()
+        else:
+            res = [PODMAN, *self._build_run_args()]
+            if not self.unsafe_run_as_root:
+                res.extend(self._build_wrapper_args())
         logger.debug(f'Generated sandbox prefix {res}')
         return res
 
+    def _take_cmd_prefix(self, env: dict[str, str] | None) -> list[str]:
+        # env is only applied to this command, and the shared state is reset
+        # before anything is awaited
+        if env:
+            self.add_envs(env)
+        try:
+            return self.build_cmd_prefix()
+        finally:
+            self.clear_env()
+
+    async def exec(
+        self, *args: str, env: dict[str, str] | None = None, stdout=None, stderr=None
+    ) -> asyncio.subprocess.Process:
+        return await create_subprocess_exec(
+            *self._take_cmd_prefix(env),
+            *args,
+            cwd=config.empty_dir,
+            stdin=DEVNULL,
+            stdout=stdout,
+            stderr=stderr,
+            start_new_session=True,
+        )
+
+    async def _start_container(self, name: str, command: list[str]):
+        await async_check_output(
+            PODMAN,
+            *self._build_run_args(),
+            '-d',
+            '--name',
+            name,
+            *command,
+            cwd=config.empty_dir,
+        )
+
+    async def _is_session_ready(self) -> bool:
+        return not await async_call(
+            PODMAN,
+            self.PODMAN_URL,
+            'exec',
+            self.session,
+            'test',
+            '-e',
+            self.READY_MARKER,
+            cwd=config.empty_dir,
+        )
+
+    async def _remove_session(self):
+        await async_check_output(
+            PODMAN,
+            self.PODMAN_URL,
+            'rm',
+            '-f',
+            '--ignore',
+            '-t',
+            '0',
+            self.session,
+            cwd=config.empty_dir,
+        )
+
+    async def _run_oneoff(self, *args: str):
+        await async_check_output(*self.build_cmd_prefix(), *args, cwd=config.empty_dir)
+
+    async def start_session(self):
+        if self.session:
+            raise ValueError('Session is already started')
+        name = f'foxbuild-{self.id}'
+        self.clear_env()
+        await self._start_container(
+            name,
+            [
+                *self._build_wrapper_args(),
+                'sh',
+                '-c',
+                f'touch {self.READY_MARKER} && exec sleep infinity',
+            ],
+        )
+        self.session = name
+        # bwrap-wrapper sets up users and mounts before running the command
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.SESSION_START_TIMEOUT
+        while not await self._is_session_ready():
+            if loop.time() > deadline:
+                raise ValueError('Sandbox session failed to start')
+            await asyncio.sleep(0.05)
+
+    async def kill(self):
+        containers = await async_check_output(
+            PODMAN,
+            self.PODMAN_URL,
+            'ps',
+            '-q',
+            '--filter',
+            f'label=foxbuild.sandbox={self.id}',
+            cwd=config.empty_dir,
+        )
+        if containers.split():
+            await async_check_output(
+                PODMAN,
+                self.PODMAN_URL,
+                'rm',
+                '-f',
+                *containers.split(),
+                cwd=config.empty_dir,
+            )
+
     async def cleanup(self):
         self.unsafe_run_as_root = True
-        prefix = self.build_cmd_prefix()
-        self._is_shutdown = True
-        dirs = (x.relative_to(self._container_tmp) for x in self._container_tmp.glob('*'))
-        dirs = (os.path.join(f'{SANDBOX_HOME}/.local/share/containers', x) for x in dirs)
         self.clear_env()
-        await async_check_output(
-            *prefix,
+        host_dirs = [*self._container_tmp.glob('*'), *self.scratch_dir.glob('*')]
+        dirs = (x.relative_to(self._container_tmp) for x in self._container_tmp.glob('*'))
+        dirs = [
+            *(os.path.join(f'{SANDBOX_HOME}/.local/share/containers', x) for x in dirs),
+            *(str(x) for x in self.scratch_dir.glob('*')),
+        ]
+        removed = not dirs
+        if self.session:
+            if not removed:
+                try:
+                    p = await self.exec(
+                        'rm', '-rf', *dirs, stdout=DEVNULL, stderr=DEVNULL
+                    )
+                    removed = not await p.wait()
+                except Exception:
+                    logger.exception('Failed to clean up in the session container')
+            await self._remove_session()
+            self.session = None
+        if not removed:
+            # no session or it was killed
+            await remove_trees(host_dirs)
+        self._is_shutdown = True
+        await self._remove_slot()
+        self._container_tmp.rmdir()
+        self.scratch_dir.rmdir()
+
+
+async def remove_trees(paths: list[Path]):
+    # Files created in sandboxes may belong to other users. Root removes them
+    # directly, otherwise one container removes all of them at once
+    if not paths:
+        return
+    if os.geteuid() == 0:
+        await async_check_output(RM, '-rf', '--', *paths, cwd=config.empty_dir)
+        return
+    sandbox = create_sandbox()
+    parents = list({path.parent for path in paths})
+    for i, parent in enumerate(parents):
+        sandbox.add_rw_bind(str(parent), f'/trees/{i}')
+    try:
+        sandbox.unsafe_run_as_root = True
+        await sandbox._run_oneoff(
             'rm',
             '-rf',
-            *dirs,
-            cwd=config.empty_dir,
+            '--',
+            *(f'/trees/{parents.index(path.parent)}/{path.name}' for path in paths),
         )
-        self._container_tmp.rmdir()
+    finally:
+        await sandbox.cleanup()
+
+
+def sessions_enabled() -> bool:
+    return config.sandbox_session or config.sandbox_backend == SandboxBackend.api
+
+
+def create_sandbox(**kwargs) -> Sandbox:
+    if config.sandbox_backend == SandboxBackend.api:
+        from foxbuild.podman_api import ApiSandbox
+
+        return ApiSandbox(**kwargs)
+    return Sandbox(**kwargs)
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from collections import Counter, deque
+from pathlib import Path
+from time import time
+
+from foxbuild.config import config
+from foxbuild.const import DEFAULT_IMAGE, SANDBOX_WORKDIR
+from foxbuild.sandbox import Sandbox, create_sandbox, sessions_enabled
+
+logger = logging.getLogger(__name__)
+
+
+class SandboxPool:
+    # Idle started sandbox sessions for the default image, configured images
+    # and the most used ones. A claimed sandbox gets the stage workspace
+    # attached to its slot and is replaced in the background
+    _idle: dict[str, deque[tuple[Sandbox, float]]]
+    _starting: Counter
+    _usage: Counter
+    _tasks: set[asyncio.Task]
+    _evict_task: asyncio.Task | None
+
+    def __init__(self):
+        self._idle = {}
+        self._starting = Counter()
+        self._usage = Counter()
+        self._tasks = set()
+        self._evict_task = None
+
+    @property
+    def enabled(self) -> bool:
+        return sessions_enabled() and config.sandbox_pool_size > 0
+
+    @property
+    def size(self) -> int:
+        return sum(len(x) for x in self._idle.values()) + sum(self._starting.values())
+
+    def _warm_images(self) -> list[str]:
+        images = [DEFAULT_IMAGE, *config.sandbox_pool_images]
+        for image, _ in self._usage.most_common(config.sandbox_pool_top_images):
+            if image not in images:
+                images.append(image)
+        return images
+
+    async def _create(self, image: str) -> Sandbox:
+        sandbox = create_sandbox(
+            overlay_nix_cache=True,
+            workdir=SANDBOX_WORKDIR,
+            image=image,
+        )
+        try:
+            await sandbox.add_slot(SANDBOX_WORKDIR)
+            await sandbox.start_session()
+        except BaseException:
+            await sandbox.cleanup()
+            raise
+        return sandbox
+
+    async def _fill_one(self, image: str):
+        try:
+            sandbox = await self._create(image)
+        except Exception:
+            logger.exception(f'Failed to start a pooled sandbox for {image}')
+            return
+        finally:
+            self._starting[image] -= 1
+        self._idle.setdefault(image, deque()).append((sandbox, time()))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _refill(self, image: str):
+        if image not in self._warm_images():
+            return
+        have = len(self._idle.get(image, ())) + self._starting[image]
+        for _ in range(config.sandbox_pool_per_image - have):
+            if self.size >= config.sandbox_pool_size:
+                break
+            self._starting[image] += 1
+            self._spawn(self._fill_one(image))
+
+    async def claim(self, image: str, workspace: Path) -> Sandbox | None:
+        if not self.enabled:
+            return None
+        self._usage[image] += 1
+        sandbox = None
+        if idle := self._idle.get(image):
+            sandbox, _ = idle.popleft()
+        self._refill(image)
+        if sandbox is None:
+            return None
+        try:
+            await sandbox.attach(workspace)
+        except BaseException:
+            await sandbox.cleanup()
+            raise
+        return sandbox
+
+    async def _evict_idle(self):
+        now = time()
+        # _fill_one can add images while a cleanup is awaited
+        for image, idle in list(self._idle.items()):
+            while idle and now - idle[0][1] > config.sandbox_pool_idle_timeout:
+                sandbox, _ = idle.popleft()
+                logger.info(f'Evicting idle pooled sandbox for {image}')
+                try:
+                    await sandbox.cleanup()
+                except Exception:
+                    logger.exception('Failed to clean up a pooled sandbox')
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(min(config.sandbox_pool_idle_timeout, 60))
+            try:
+                await self._evict_idle()
+            except Exception:
+                logger.exception('Evicting idle pooled sandboxes failed')
+
+    def start(self):
+        if not self.enabled:
+            return
+        for image in self._warm_images():
+            self._refill(image)
+        self._evict_task = asyncio.create_task(self._evict_loop())
+
+    async def stop(self):
+        tasks = [*self._tasks]
+        if self._evict_task:
+            tasks.append(self._evict_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._evict_task = None
+        for idle in list(self._idle.values()):
+            while idle:
+                sandbox, _ = idle.popleft()
+                try:
+                    await sandbox.cleanup()
+                except Exception:
+                    logger.exception('Failed to clean up a pooled sandbox')
+
+
+sandbox_pool = SandboxPool()
+
+__all__ = ['SandboxPool', 'sandbox_pool']
@@ -1,3 +1,5 @@
+from enum import Enum
+
 from pydantic import BaseModel
 
 
@@ -7,17 +9,68 @@ class StandaloneRunInfo(BaseModel):
     repo_name: str
     commit_sha: str
     run_id: str
+    # None for forks, GitHub doesn't report their branches
+    branch: str | None = None
+    default_branch: str | None = None
+    # requested again by a user, cached stage results aren't reused
+    rerun: bool = False
 
 
 class StageResult(BaseModel):
     exit_code: int
+    # head and tail of the output, the full log is in log_file
     stdout: str
     stderr: str
+    truncated: bool = False
+    log_file: str | None = None
+    # reused from the result cache
+    cached: bool = False
 
 
 class WorkflowResult(BaseModel):
     stages: dict[str, StageResult | None]
 
+    @property
+    def is_ok(self) -> bool:
+        return all(st is not None and st.exit_code == 0 for st in self.stages.values())
+
 
 class RunResult(BaseModel):
     workflows: dict[str, WorkflowResult | None]
+
+    @property
+    def is_ok(self) -> bool:
+        return all(wf is not None and wf.is_ok for wf in self.workflows.values())
+
+
+class StageState(Enum):
+    pending = 'pending'
+    running = 'running'
+    finished = 'finished'
+    skipped = 'skipped'
+    cancelled = 'cancelled'
+
+
+class StageStatus(BaseModel):
+    workflow: str
+    stage: str
+    state: StageState = StageState.pending
+    exit_code: int | None = None
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def is_active(self) -> bool:
+        return self.state in (StageState.pending, StageState.running)
+
+
+class RunStatus(BaseModel):
+    provider: str
+    run_id: str
+    repo_name: str | None = None
+    commit_sha: str | None = None
+    finished: bool = False
+    started_at: float
+    finished_at: float | None = None
+    # by log name
+    stages: dict[str, StageStatus] = {}
@@ -1,8 +1,20 @@
+import re
 from pathlib import Path
-from pydantic import BaseModel, StringConstraints, field_validator, Field
+from pydantic import (
+    BaseModel,
+    BeforeValidator,
+    ByteSize,
+    PositiveFloat,
+    StringConstraints,
+    field_validator,
+    model_validator,
+    Field,
+)
 from pydantic_core.core_schema import ValidationInfo
 from typing import Annotated
 
+HASH_PLACEHOLDER_RE = re.compile(r'\{hash:([^}]+)\}')
+
 
 class EnvSettings:
     use_flake: str | bool | None = None
@@ -33,20 +45,125 @@ class EnvSettings:
         return res
 
 
+class CacheDef(BaseModel):
+    # `{hash:poetry.lock,**/package-lock.json}` is replaced with a hash
+    # of the matching files
+    key: str
+    # relative to the workdir, or to the home dir if they start with ~/
+    paths: list[str]
+    # prefixes of keys of older caches to restore if there's none for key
+    restore_keys: list[str] = []
+
+    @field_validator('key')
+    @classmethod
+    def v_key(cls, v: str):
+        for m in HASH_PLACEHOLDER_RE.finditer(v):
+            for pattern in m.group(1).split(','):
+                parts = Path(pattern.strip()).parts
+                if (
+                    not parts
+                    or parts[0] == '/'
+                    or '..' in parts
+                    or any('**' in x and x != '**' for x in parts)
+                ):
+                    raise ValueError(
+                        f'invalid hash pattern {pattern!r}, patterns must be '
+                        f'relative to the workdir and can\'t contain ..'
+                    )
+        return v
+
+    @field_validator('paths')
+    @classmethod
+    def v_paths(cls, v: list[str]):
+        basedir = Path('/meow')
+        for path in v:
+            relative = path.removeprefix('~/')
+            resolved = (basedir / relative).resolve()
+            if not resolved.is_relative_to(basedir) or resolved == basedir:
+                raise ValueError('paths must be inside the workdir or the home dir')
+        return v
+
+
+class ResourcesDef(BaseModel):
+    # reserved for the stage and enforced as cgroup limits of its sandbox
+    cpus: PositiveFloat | None = None
+    # bytes, or a string like 2GiB
+    memory: ByteSize | None = None
+
+
 class _ConditionSettings:
     if_: Annotated[str, Field(alias='if')] | None = None
 
 
 class StageDef(EnvSettings, _ConditionSettings, BaseModel):
-    needs: str | None = None
+    needs: (
+        Annotated[
+            list[str],
+            BeforeValidator(lambda v: [v] if isinstance(v, str) else v),
+        ]
+        | None
+    ) = None
     run: str
+    # paths the result depends on, the whole tree if not set
+    inputs: list[str] | None = None
+    # reuse the result of a previous successful run with the same inputs.
+    # Reruns requested on GitHub always run the stage again
+    cache_result: bool = True
+    cache: CacheDef | None = None
+    # images used by podman inside the sandbox, pulled into the shared store
+    nested_images: list[str] | None = None
+    resources: ResourcesDef | None = None
 
 
 class WorkflowDef(_ConditionSettings, BaseModel):
     stages: list[str]
+    # cancel running stages of this workflow as soon as one of them fails
+    fail_fast: bool = False
 
 
 class Foxfile(EnvSettings, BaseModel):
     nix_paths: list[str] | None = ['flake.nix', 'flake.lock', 'shell.nix']
     stages: dict[str, StageDef]
     workflows: dict[str, WorkflowDef]
+    # cancel everything still running as soon as any stage fails
+    fail_fast: bool = False
+
+    @model_validator(mode='after')
+    def v_stage_graph(self):
+        for stage_name, stage in self.stages.items():
+            for dep in stage.needs or ():
+                if dep not in self.stages:
+                    raise ValueError(f'stage {stage_name} needs unknown stage {dep}')
+
+        for workflow_name, workflow in self.workflows.items():
+            if len(set(workflow.stages)) != len(workflow.stages):
+                raise ValueError(f'workflow {workflow_name} has duplicate stages')
+            for stage_name in workflow.stages:
+                if stage_name not in self.stages:
+                    raise ValueError(
+                        f'workflow {workflow_name} references unknown stage {stage_name}'
+                    )
+                for dep in self.stages[stage_name].needs or ():
+                    if dep not in workflow.stages:
+                        raise ValueError(
+                            f'stage {stage_name} needs {dep}, '
+                            f'which is not in workflow {workflow_name}'
+                        )
+
+        # 0 - not visited, 1 - on the current path, 2 - done
+        state = dict.fromkeys(self.stages, 0)
+
+        def visit(stage_name: str, path: list[str]):
+            if state[stage_name] == 2:
+                return
+            if state[stage_name] == 1:
+                cycle = path[path.index(stage_name) :] + [stage_name]
+                raise ValueError(f'stage dependency cycle: {" -> ".join(cycle)}')
+            state[stage_name] = 1
+            for dep in self.stages[stage_name].needs or ():
+                visit(dep, path + [stage_name])
+            state[stage_name] = 2
+
+        for stage_name in self.stages:
+            visit(stage_name, [])
+        return self
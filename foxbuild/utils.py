@@ -1,5 +1,7 @@
+import asyncio
 from asyncio import create_subprocess_exec
 
+import fcntl
 import logging
 import os
 import subprocess
@@ -10,6 +12,10 @@ from foxbuild.config import config
 
 logger = logging.getLogger(__name__)
 
+# file locks held by other processes are polled for, a blocking flock
+# couldn't be cancelled
+LOCK_POLL_INTERVAL = 0.1
+
 
 def get_bin(name: str) -> str:
     abspath = subprocess.check_output(f'which {name}', shell=True).decode().strip()
@@ -24,13 +30,35 @@ NIX = get_bin('nix')
 JQ = get_bin('jq')
 GIT = get_bin('git')
 PODMAN = get_bin('podman')
+CP = get_bin('cp')
+MOUNT = get_bin('mount')
+UMOUNT = get_bin('umount')
+RM = get_bin('rm')
 
 
 async def async_check_output(*args: str | Path, cwd: Path | str) -> str:
     logger.debug(f'Running {args}')
     p = await create_subprocess_exec(*args, cwd=cwd, stdin=DEVNULL, stdout=PIPE)
-    await p.wait()
+    # read before waiting, the process blocks once the pipe buffer is full
+    stdout, _ = await p.communicate()
     if p.returncode:
         logger.error(f'Process exited with code {p.returncode}')
         raise ValueError
-    return (await p.stdout.read()).decode()
+    return stdout.decode()
+
+
+async def async_call(*args: str | Path, cwd: Path | str) -> int:
+    logger.debug(f'Running {args}')
+    p = await create_subprocess_exec(
+        *args, cwd=cwd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL
+    )
+    return await p.wait()
+
+
+async def async_flock(f, operation: int):
+    while True:
+        try:
+            fcntl.flock(f, operation | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
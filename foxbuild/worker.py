@@ -0,0 +1,230 @@
+import asyncio
+import logging
+from pathlib import Path
+from typing import Callable
+
+import httpx
+
+from foxbuild.config import config, WorkspaceMode
+from foxbuild.coordinator import StaleJobError
+from foxbuild import metrics
+from foxbuild.exceptions import ConfigurationError
+from foxbuild.gauges import register_gauges
+from foxbuild.image_store import image_store
+from foxbuild.janitor import janitor
+from foxbuild.podman_api import close_client as close_podman_client
+from foxbuild.runner import Runner
+from foxbuild.runner.budget import stage_budget
+from foxbuild.runner.logs import follow_log
+from foxbuild.runner.mirrors import mirror_manager
+from foxbuild.runner.profiles import profile_store
+from foxbuild.runner.stage import StageRunner
+from foxbuild.runner.workspace import ensure_base, get_run_dir, hold_run
+from foxbuild.sandbox import remove_trees
+from foxbuild.sandbox_pool import sandbox_pool
+from foxbuild.schemas import StageResult, StandaloneRunInfo
+from foxbuild.schemas.foxfile import Foxfile
+
+logger = logging.getLogger(__name__)
+
+# of requests other than the long poll
+REQUEST_TIMEOUT = 30
+REQUEST_RETRIES = 5
+POLL_RETRY_DELAY = 5
+
+
+class Worker:
+    # Runs stages for a coordinator. Each of max_parallel_stages slots
+    # long-polls it for a stage job, keeps the job leased while running it
+    # and uploads the log as it's written. The stage is killed as soon as
+    # the coordinator stops accepting heartbeats for the job.
+    # queue_lease_seconds must be the same as the coordinator's
+    _client: httpx.AsyncClient | None
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=config.coordinator_url,
+                headers={'Authorization': f'Bearer {config.worker_token}'},
+                timeout=REQUEST_TIMEOUT,
+            )
+        return self._client
+
+    async def _post(self, url: str, **kwargs) -> httpx.Response:
+        # transient errors are retried, 410 means the job is stale
+        for i in range(REQUEST_RETRIES):
+            is_last = i == REQUEST_RETRIES - 1
+            try:
+                resp = await self.client.post(url, **kwargs)
+            except httpx.TransportError:
+                if is_last:
+                    raise
+            else:
+                if resp.status_code == 410:
+                    raise StaleJobError
+                if resp.status_code < 500 or is_last:
+                    resp.raise_for_status()
+                    return resp
+            await asyncio.sleep(2**i)
+
+    async def _prepare(self, payload: dict) -> StageRunner:
+        run_info = StandaloneRunInfo.model_validate(payload['run_info'])
+        runner = Runner(None, run_info)
+        runner.foxfile = Foxfile.model_validate(payload['foxfile'])
+        key = payload['key']
+        await mirror_manager.ensure_commit(run_info)
+        if config.workspace_mode != WorkspaceMode.clone:
+            await ensure_base(run_info)
+        # left by an earlier attempt of this job
+        if (workdir := get_run_dir(run_info) / key).exists():
+            await remove_trees([workdir])
+        (runner.logs_dir / f'{key}.log').unlink(missing_ok=True)
+        return StageRunner(
+            key,
+            runner,
+            runner.foxfile.workflows[payload['workflow']],
+            runner.foxfile.stages[payload['stage']],
+        )
+
+    async def _upload_log(self, job_url: str, path: Path, is_active: Callable):
+        async for offset, chunk in follow_log(path, 0, is_active):
+            await self._post(
+                f'{job_url}/log', params={'offset': offset - len(chunk)}, content=chunk
+            )
+
+    async def _execute(self, payload: dict, job_url: str) -> StageResult:
+        stage_runner = await self._prepare(payload)
+        done = False
+        upload = asyncio.create_task(
+            self._upload_log(job_url, stage_runner.log_file, lambda: not done)
+        )
+        resources = stage_runner.stage.resources
+        try:
+            async with stage_budget.slot(
+                stage_runner.runner.run_info.run_id,
+                resources and resources.cpus,
+                resources and resources.memory,
+            ):
+                result = await stage_runner.run()
+        except BaseException:
+            upload.cancel()
+            await asyncio.gather(upload, return_exceptions=True)
+            raise
+        done = True
+        await upload
+        return result
+
+    async def _keep_leased(self, job_url: str, work: asyncio.Task):
+        while True:
+            await asyncio.sleep(config.queue_lease_seconds / 3)
+            try:
+                await self._post(f'{job_url}/heartbeat')
+            except StaleJobError:
+                logger.info(f'{job_url} was cancelled by the coordinator')
+                work.cancel()
+                return
+            except httpx.HTTPError:
+                logger.exception(f'Heartbeat of {job_url} failed')
+
+    async def _run_job(self, job: dict):
+        job_url = f'/worker/jobs/{job["id"]}/{job["attempt"]}'
+        work = asyncio.create_task(self._execute(job['payload'], job_url))
+        heartbeat = asyncio.create_task(self._keep_leased(job_url, work))
+        try:
+            result = await work
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                work.cancel()
+                await asyncio.gather(work, return_exceptions=True)
+                raise
+            # by _keep_leased
+            return
+        except Exception as e:
+            logger.exception(f'{job_url} failed')
+            await self._post(f'{job_url}/fail', json={'error': repr(e)})
+            return
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+        await self._post(
+            f'{job_url}/result',
+            content=result.model_dump_json(exclude={'log_file'}),
+            headers={'Content-Type': 'application/json'},
+        )
+
+    async def _slot(self, idx: int):
+        while True:
+            try:
+                resp = await self.client.post(
+                    '/worker/claim',
+                    timeout=config.worker_poll_timeout + REQUEST_TIMEOUT,
+                )
+                resp.raise_for_status()
+            except httpx.HTTPError:
+                logger.exception('Failed to poll the coordinator')
+                await asyncio.sleep(POLL_RETRY_DELAY)
+                continue
+            if resp.status_code == 204:
+                continue
+            job = resp.json()
+            logger.info(
+                f'Slot {idx} running job {job["id"]} (attempt {job["attempt"]})'
+            )
+            run_info = StandaloneRunInfo.model_validate(job['payload']['run_info'])
+            try:
+                # keeps janitors away from the base and workspaces of the run
+                async with hold_run(run_info):
+                    await self._run_job(job)
+            except StaleJobError:
+                logger.info(f'Job {job["id"]} was cancelled by the coordinator')
+            except httpx.HTTPError:
+                logger.exception(f'Failed to report job {job["id"]}')
+
+    async def run(self):
+        if not config.coordinator_url or not config.worker_token:
+            raise ConfigurationError(
+                'coordinator_url and worker_token must be set for a worker'
+            )
+        if config.host_cpus is None or config.host_memory is None:
+            raise ConfigurationError(
+                'host_cpus and host_memory must be set for a worker, '
+                'to its share of the host'
+            )
+        metrics_server = None
+        if config.worker_metrics_port is not None:
+            register_gauges()
+            metrics_server = await metrics.start_server(
+                config.worker_metrics_host,
+                config.worker_metrics_port,
+                janitor.update_runs_dir_size,
+            )
+        mirror_manager.start()
+        profile_store.start()
+        sandbox_pool.start()
+        janitor.start()
+        image_store.start()
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for i in range(config.max_parallel_stages):
+                    tg.create_task(self._slot(i))
+        finally:
+            await mirror_manager.stop()
+            await profile_store.stop()
+            await sandbox_pool.stop()
+            await janitor.stop()
+            await image_store.stop()
+            await close_podman_client()
+            if self._client is not None:
+                await self._client.aclose()
+            if metrics_server is not None:
+                metrics_server.close()
+                await metrics_server.wait_closed()
+
+
+worker = Worker()
+
+__all__ = ['Worker', 'worker']
@@ -0,0 +1,11 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# foxbuild.config is read on import
+os.environ.setdefault('FOXBUILD_HOST', '127.0.0.1')
+os.environ.setdefault('FOXBUILD_PORT', '8000')
+DATA_DIR = tempfile.mkdtemp(prefix='foxbuild-test-')
+os.environ['FOXBUILD_DATA_DIR'] = DATA_DIR
+atexit.register(shutil.rmtree, DATA_DIR, True)
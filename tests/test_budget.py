@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+from foxbuild.runner.budget import StageBudget
+
+
+class Holder:
+    # holds a slot of the budget until released
+    def __init__(self, budget: StageBudget, owner: str, cpus: float, memory: int):
+        self.acquired = asyncio.Event()
+        self.release = asyncio.Event()
+        self.task = asyncio.create_task(self._hold(budget, owner, cpus, memory))
+
+    async def _hold(self, budget: StageBudget, owner: str, cpus: float, memory: int):
+        async with budget.slot(owner, cpus, memory):
+            self.acquired.set()
+            await self.release.wait()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.parametrize('other_waiter', [False, True])
+def test_cancel_while_released(other_waiter):
+    async def main():
+        budget = StageBudget(2, 4, 1024)
+        z = Holder(budget, 'z', 1, 0)
+        a = Holder(budget, 'a', 1, 0)
+        await settle()
+        b = Holder(budget, 'b', 1, 0)
+        if other_waiter:
+            # doesn't fit while z is running
+            b2 = Holder(budget, 'b', 4, 0)
+        await settle()
+        assert budget.waiting == (2 if other_waiter else 1)
+        # a's release runs before b's cancellation is handled
+        a.release.set()
+        b.task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await b.task
+        await a.task
+        assert budget.waiting == (1 if other_waiter else 0)
+        z.release.set()
+        await z.task
+        if other_waiter:
+            await b2.acquired.wait()
+            b2.release.set()
+            await b2.task
+        assert budget.in_use == 0
+        assert budget.waiting == 0
+        assert budget.reserved_cpus == 0
+
+    asyncio.run(main())
+
+
+def test_cancel_while_waiting():
+    async def main():
+        budget = StageBudget(1, 4, 1024)
+        a = Holder(budget, 'a', 1, 0)
+        await settle()
+        b = Holder(budget, 'b', 1, 0)
+        c = Holder(budget, 'c', 1, 0)
+        await settle()
+        b.task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await b.task
+        assert budget.waiting == 1
+        a.release.set()
+        await c.acquired.wait()
+        c.release.set()
+        await asyncio.gather(a.task, c.task)
+        assert budget.in_use == 0
+
+    asyncio.run(main())
+
+
+def test_big_reservation_is_not_overtaken():
+    async def main():
+        budget = StageBudget(10, 4, 1024)
+        a = Holder(budget, 'a', 3, 0)
+        await settle()
+        b = Holder(budget, 'b', 2, 0)
+        await settle()
+        # would fit, but b is waiting for its reservation first
+        c = Holder(budget, 'c', 1, 0)
+        await settle()
+        assert not b.acquired.is_set()
+        assert not c.acquired.is_set()
+        a.release.set()
+        await b.acquired.wait()
+        await c.acquired.wait()
+        assert budget.reserved_cpus == 3
+        b.release.set()
+        c.release.set()
+        await asyncio.gather(a.task, b.task, c.task)
+
+    asyncio.run(main())
+
+
+def test_freed_capacity_goes_to_owner_with_fewest_running():
+    async def main():
+        budget = StageBudget(2, 4, 1024)
+        a1 = Holder(budget, 'a', 1, 0)
+        b1 = Holder(budget, 'b', 1, 0)
+        await settle()
+        a2 = Holder(budget, 'a', 1, 0)
+        await settle()
+        b2 = Holder(budget, 'b', 1, 0)
+        await settle()
+        # a keeps a1 running, b has none after b1
+        b1.release.set()
+        await b1.task
+        await settle()
+        assert b2.acquired.is_set()
+        assert not a2.acquired.is_set()
+        for holder in (a1, a2, b2):
+            holder.release.set()
+        await asyncio.gather(a1.task, a2.task, b2.task)
+        assert budget.in_use == 0
+
+    asyncio.run(main())
+
+
+def test_reservation_is_capped_at_host_capacity():
+    async def main():
+        budget = StageBudget(2, 4, 1024)
+        a = Holder(budget, 'a', 16, 4096)
+        await a.acquired.wait()
+        assert budget.reserved_cpus == 4
+        assert budget.reserved_memory == 1024
+        a.release.set()
+        await a.task
+
+    asyncio.run(main())
@@ -0,0 +1,242 @@
+import asyncio
+from pathlib import Path
+
+import httpx
+import pytest
+
+from foxbuild import coordinator, web
+from foxbuild.config import config
+from foxbuild.coordinator import StageDispatcher
+from foxbuild.job_queue import JobQueue
+from foxbuild.runner import logs
+from foxbuild.runner.mirrors import mirror_manager
+from foxbuild.runner.stage import StageRunner
+from foxbuild.schemas import StageResult
+from foxbuild.worker import Worker
+
+TOKEN = 'meow'
+LEASE_SECONDS = 0.6
+
+FOXFILE = {
+    'stages': {
+        'echo': {'run': 'echo'},
+        'hang': {'run': 'hang'},
+    },
+    'workflows': {'main': {'stages': ['echo', 'hang']}},
+}
+
+
+class FakeStages:
+    # StageRunner.run replacement, `run:` of the stage picks the behavior
+    def __init__(self):
+        self.started: dict[str, asyncio.Event] = {}
+        self.cancelled: set[str] = set()
+        self.release = asyncio.Event()
+
+    async def run(self, stage_runner: StageRunner) -> StageResult:
+        key = stage_runner.log_file.stem
+        self.started.setdefault(key, asyncio.Event()).set()
+        if stage_runner.stage.run == 'echo':
+            # several writes, so the log is uploaded in more than one chunk
+            stage_runner.log_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(stage_runner.log_file, 'wb') as f:
+                for i in range(3):
+                    f.write(f'{key} line {i}\n'.encode())
+                    f.flush()
+                    await asyncio.sleep(0.1)
+            await self.release.wait()
+            return StageResult(exit_code=0, stdout=f'{key} done', stderr='')
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.cancelled.add(key)
+            raise
+
+    async def wait_started(self, key: str):
+        await self.started.setdefault(key, asyncio.Event()).wait()
+
+
+@pytest.fixture
+def dispatcher(tmp_path, monkeypatch):
+    queue = JobQueue(
+        tmp_path / 'queue.sqlite3',
+        lease_seconds=LEASE_SECONDS,
+        max_attempts=3,
+        retry_delay=0,
+    )
+    queue.open()
+    res = StageDispatcher(queue)
+    monkeypatch.setattr(web, 'stage_dispatcher', res)
+    monkeypatch.setattr(coordinator, 'CLAIM_POLL_INTERVAL', 0.05)
+    monkeypatch.setattr(logs, 'FOLLOW_INTERVAL', 0.05)
+    monkeypatch.setattr(config, 'coordinator', True)
+    monkeypatch.setattr(config, 'worker_token', TOKEN)
+    monkeypatch.setattr(config, 'worker_poll_timeout', 1)
+    monkeypatch.setattr(config, 'queue_lease_seconds', LEASE_SECONDS)
+    monkeypatch.setattr(config, 'max_parallel_stages', 1)
+    # the workers share the stage budget of this process
+    monkeypatch.setattr(config, 'stage_default_cpus', 0)
+    yield res
+    queue.close()
+
+
+@pytest.fixture
+def fake_stages(monkeypatch) -> FakeStages:
+    async def ensure_commit(run_info):
+        pass
+
+    res = FakeStages()
+    monkeypatch.setattr(StageRunner, 'run', lambda self: res.run(self))
+    monkeypatch.setattr(mirror_manager, 'ensure_commit', ensure_commit)
+    return res
+
+
+def make_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(web.app),
+        base_url='http://coordinator',
+        headers={'Authorization': f'Bearer {TOKEN}'},
+    )
+
+
+def make_payload(run_id: str, key: str, stage: str) -> dict:
+    return {
+        'run_info': {
+            'provider': 'gh',
+            'clone_url': 'https://example.com/repo.git',
+            'repo_name': 'fox/repo',
+            'commit_sha': '0' * 40,
+            'run_id': run_id,
+        },
+        'foxfile': FOXFILE,
+        'key': key,
+        'workflow': 'main',
+        'stage': stage,
+    }
+
+
+async def start_workers(count: int) -> list[asyncio.Task]:
+    tasks = []
+    for _ in range(count):
+        worker = Worker()
+        worker._client = make_client()
+        tasks.append(asyncio.create_task(worker._slot(0)))
+    return tasks
+
+
+async def stop_workers(tasks: list[asyncio.Task]):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def test_stages_run_on_several_workers(
+    dispatcher: StageDispatcher, fake_stages: FakeStages, tmp_path: Path
+):
+    async def main():
+        workers = await start_workers(2)
+        try:
+            runs = [
+                asyncio.create_task(
+                    dispatcher.run_stage(
+                        make_payload('several', key, 'echo'),
+                        tmp_path / 'logs' / f'{key}.log',
+                    )
+                )
+                for key in ('0_0', '1_0')
+            ]
+            # each worker has one slot, so both are busy at the same time
+            await asyncio.wait_for(fake_stages.wait_started('0_0'), 5)
+            await asyncio.wait_for(fake_stages.wait_started('1_0'), 5)
+            assert dispatcher.pending == 2
+            fake_stages.release.set()
+            results = await asyncio.wait_for(asyncio.gather(*runs), 5)
+        finally:
+            await stop_workers(workers)
+        for key, result in zip(('0_0', '1_0'), results):
+            assert result.exit_code == 0
+            assert result.stdout == f'{key} done'
+            assert Path(result.log_file).read_text() == ''.join(
+                f'{key} line {i}\n' for i in range(3)
+            )
+        assert dispatcher.pending == 0
+
+    asyncio.run(main())
+
+
+def test_takeover_after_missed_heartbeat(
+    dispatcher: StageDispatcher, fake_stages: FakeStages, tmp_path: Path
+):
+    async def main():
+        log_file = tmp_path / 'logs' / '0_0.log'
+        run = asyncio.create_task(
+            dispatcher.run_stage(make_payload('takeover', '0_0', 'echo'), log_file)
+        )
+        async with make_client() as lost:
+            resp = await lost.post('/worker/claim')
+            job = resp.json()
+            assert job['attempt'] == 1
+            job_url = f'/worker/jobs/{job["id"]}/1'
+            assert (await lost.post(f'{job_url}/heartbeat')).status_code == 204
+
+            # uploads resume from the size the coordinator returns
+            resp = await lost.post(
+                f'{job_url}/log', params={'offset': 0}, content=b'ab'
+            )
+            assert resp.json() == {'size': 2}
+            resp = await lost.post(
+                f'{job_url}/log', params={'offset': 5}, content=b'x'
+            )
+            assert resp.json() == {'size': 2}
+            resp = await lost.post(
+                f'{job_url}/log', params={'offset': 1}, content=b'bc'
+            )
+            assert resp.json() == {'size': 3}
+            assert log_file.read_bytes() == b'abc'
+
+            # the lost worker stops sending heartbeats and its lease expires
+            await asyncio.sleep(LEASE_SECONDS * 1.5)
+            fake_stages.release.set()
+            workers = await start_workers(1)
+            try:
+                result = await asyncio.wait_for(run, 5)
+            finally:
+                await stop_workers(workers)
+            assert result.exit_code == 0
+
+            assert (await lost.post(f'{job_url}/heartbeat')).status_code == 410
+            resp = await lost.post(f'{job_url}/log', params={'offset': 3}, content=b'd')
+            assert resp.status_code == 410
+            resp = await lost.post(
+                f'{job_url}/result',
+                json={'exit_code': 1, 'stdout': '', 'stderr': ''},
+            )
+            assert resp.status_code == 410
+        # the log of the lost attempt was replaced
+        assert log_file.read_text() == ''.join(f'0_0 line {i}\n' for i in range(3))
+
+    asyncio.run(main())
+
+
+def test_cancel_kills_stage_on_worker(
+    dispatcher: StageDispatcher, fake_stages: FakeStages, tmp_path: Path
+):
+    async def main():
+        workers = await start_workers(1)
+        try:
+            run = asyncio.create_task(
+                dispatcher.run_stage(
+                    make_payload('cancel', '0_1', 'hang'), tmp_path / 'logs' / '0_1.log'
+                )
+            )
+            await asyncio.wait_for(fake_stages.wait_started('0_1'), 5)
+            run.cancel()
+            # the next heartbeat gets a 410 and the worker kills the stage
+            async with asyncio.timeout(LEASE_SECONDS * 3):
+                while '0_1' not in fake_stages.cancelled:
+                    await asyncio.sleep(0.05)
+            assert dispatcher.pending == 0
+        finally:
+            await stop_workers(workers)
+
+    asyncio.run(main())
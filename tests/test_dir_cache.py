@@ -0,0 +1,40 @@
+import asyncio
+import os
+
+import pytest
+from pydantic import ValidationError
+
+from foxbuild.runner.dir_cache import hash_files, render_key
+from foxbuild.schemas.foxfile import CacheDef
+
+
+@pytest.mark.parametrize(
+    'key', ['deps-{hash:/etc/passwd}', 'deps-{hash:../x}', 'deps-{hash:a/**b}']
+)
+def test_hash_patterns_must_stay_in_workdir(key):
+    with pytest.raises(ValidationError):
+        CacheDef(key=key, paths=['.venv'])
+
+
+def test_hash_files_skips_links_out_of_workdir(tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    (outside / 'secret').write_text('secret')
+    workdir = tmp_path / 'workdir'
+    workdir.mkdir()
+    (workdir / 'poetry.lock').write_text('lock')
+    expected = hash_files(workdir, ['poetry.lock', '*'])
+
+    os.symlink(outside, workdir / 'dir_link')
+    os.symlink(outside / 'secret', workdir / 'file_link')
+    os.symlink('poetry.lock', workdir / 'inner_link')
+    assert hash_files(workdir, ['poetry.lock', '*', 'dir_link/*']) == expected
+
+    (workdir / 'poetry.lock').write_text('changed')
+    assert hash_files(workdir, ['poetry.lock']) != expected
+
+
+def test_render_key(tmp_path):
+    (tmp_path / 'a.lock').write_bytes(b'x' * (3 * 1024 * 1024))
+    key = asyncio.run(render_key('deps-{hash:*.lock}-v1', tmp_path))
+    assert key == f'deps-{hash_files(tmp_path, ["*.lock"])}-v1'
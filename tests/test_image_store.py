@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from foxbuild import image_store as image_store_module
+from foxbuild.config import config
+from foxbuild.image_store import ImageStore
+
+
+class FakePodman:
+    # tags of the store, a pull moves the tag to the next id
+    def __init__(self):
+        self.tags: dict[str, str] = {}
+        self.images: set[str] = set()
+        self.removed: list[str] = []
+        self.pulls = 0
+
+    async def __call__(self, *args, cwd):
+        assert args[1:5] == ('--root', args[2], '--runroot', args[4])
+        args = args[5:]
+        if args[0] == 'pull':
+            self.pulls += 1
+            image_id = f'{self.pulls:064x}'
+            self.images.add(image_id)
+            self.tags[args[-1]] = image_id
+            return image_id + '\n'
+        if args[0] == 'images':
+            if args[-1] == 'dangling=true':
+                ids = self.images - set(self.tags.values())
+            else:
+                ids = {self.tags[args[-1]]} if args[-1] in self.tags else set()
+            return ''.join(f'sha256:{x}\n' for x in ids)
+        if args[:2] == ('image', 'rm'):
+            for image_id in args[3:]:
+                self.images.discard(image_id)
+                self.removed.append(image_id)
+            return ''
+        raise AssertionError(args)
+
+
+@pytest.fixture
+def podman(monkeypatch):
+    res = FakePodman()
+    monkeypatch.setattr(image_store_module, 'async_check_output', res)
+    monkeypatch.setattr(config, 'image_store_refresh_interval', 0)
+    return res
+
+
+def test_replaced_images_are_kept_for_a_while(tmp_path, podman, monkeypatch):
+    store = ImageStore(tmp_path)
+    now = 1000.0
+    monkeypatch.setattr(image_store_module, 'time', lambda: now)
+    monkeypatch.setattr(config, 'image_store_replaced_retention', 100)
+
+    asyncio.run(store.ensure(['alpine']))
+    first = podman.tags['alpine']
+    asyncio.run(store.prune())
+    assert podman.removed == []
+
+    now = 1050.0
+    asyncio.run(store.ensure(['alpine']))
+    assert podman.tags['alpine'] != first
+    asyncio.run(store.prune())
+    # replaced just now, though it was created long ago
+    assert podman.removed == []
+
+    now = 1200.0
+    asyncio.run(store.prune())
+    assert podman.removed == [first]
+    asyncio.run(store.prune())
+    assert podman.removed == [first]
+
+
+def test_unrecorded_dangling_images_get_the_retention_too(
+    tmp_path, podman, monkeypatch
+):
+    store = ImageStore(tmp_path)
+    now = 1000.0
+    monkeypatch.setattr(image_store_module, 'time', lambda: now)
+    monkeypatch.setattr(config, 'image_store_replaced_retention', 100)
+    podman.images.add('f' * 64)
+
+    asyncio.run(store.prune())
+    assert podman.removed == []
+    now = 1200.0
+    asyncio.run(store.prune())
+    assert podman.removed == ['f' * 64]
@@ -0,0 +1,69 @@
+import asyncio
+import os
+
+from foxbuild.config import config
+from foxbuild.janitor import Janitor
+from foxbuild.runner.workspace import get_run_dir, hold_run, try_lock_run_dir
+from foxbuild.schemas import StandaloneRunInfo
+
+
+def make_run_info(run_id: str) -> StandaloneRunInfo:
+    return StandaloneRunInfo(
+        provider='test',
+        run_id=run_id,
+        repo_name='owner/repo',
+        clone_url='https://example.com/owner/repo.git',
+        commit_sha='0' * 40,
+    )
+
+
+def make_old_run(run_info: StandaloneRunInfo):
+    run_dir = get_run_dir(run_info)
+    (run_dir / 'base').mkdir(parents=True, exist_ok=True)
+    (run_dir / 'base' / 'file').write_text('meow')
+    os.utime(run_dir, (0, 0))
+
+
+def test_sweep_skips_held_runs(monkeypatch):
+    monkeypatch.setattr(config, 'runs_retention', 60)
+    held = make_run_info('held')
+    free = make_run_info('free')
+
+    async def main():
+        make_old_run(free)
+        async with hold_run(held):
+            make_old_run(held)
+            assert await Janitor().sweep() > 0
+            assert (get_run_dir(held) / 'base' / 'file').exists()
+            assert not get_run_dir(free).exists()
+
+    asyncio.run(main())
+
+
+def test_hold_waits_for_removal(monkeypatch):
+    run_info = make_run_info('removed')
+    run_dir = get_run_dir(run_info)
+
+    async def main():
+        make_old_run(run_info)
+        lock = try_lock_run_dir(run_dir)
+        hold = hold_run(run_info)
+        task = asyncio.create_task(hold.__aenter__())
+        await asyncio.sleep(0.3)
+        assert not task.done()
+        # like the janitor, removes the run dir while holding its lock
+        (run_dir / 'base' / 'file').unlink()
+        (run_dir / 'base').rmdir()
+        (run_dir / 'run.lock').unlink()
+        run_dir.rmdir()
+        lock.close()
+        await task
+        # recreated, and the hold is on the new lock file
+        assert run_dir.is_dir()
+        assert try_lock_run_dir(run_dir) is None
+        await hold.__aexit__(None, None, None)
+        lock = try_lock_run_dir(run_dir)
+        assert lock is not None
+        lock.close()
+
+    asyncio.run(main())
@@ -0,0 +1,54 @@
+import multiprocessing
+from time import time
+
+from foxbuild.runner.lru_index import LruIndex
+
+
+def _add_entries(root, prefix: str, count: int):
+    index = LruIndex(root)
+    for i in range(count):
+        with index.updating() as entries:
+            entries[f'{prefix}{i}'] = {'last_used': time(), 'size': 1}
+
+
+def test_instances_see_each_others_entries(tmp_path):
+    a = LruIndex(tmp_path)
+    b = LruIndex(tmp_path)
+    assert a.entries == {}
+    _add_entries(tmp_path, 'x', 1)
+    with b.updating() as entries:
+        entries['y'] = {'last_used': time(), 'size': 2}
+    assert set(a.entries) == {'x0', 'y'}
+    assert a.total_size == 3
+
+
+def test_processes_dont_lose_entries(tmp_path):
+    ctx = multiprocessing.get_context('fork')
+    processes = [
+        ctx.Process(target=_add_entries, args=(tmp_path, f'p{i}-', 20))
+        for i in range(4)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+    assert len(LruIndex(tmp_path).entries) == 80
+
+
+def test_evict_least_recently_used(tmp_path):
+    index = LruIndex(tmp_path)
+    removed_files = []
+    with index.updating() as entries:
+        for i, name in enumerate(['old', 'new', 'kept', 'unknown']):
+            entries[name] = {'last_used': i, 'size': None if i == 3 else 10}
+        entries['kept']['last_used'] = -1
+        removed = index.evict(entries, removed_files.append, 2, None, keep='kept')
+    assert removed == ['old', 'new']
+    assert removed_files == removed
+    assert set(LruIndex(tmp_path).entries) == {'kept', 'unknown'}
+
+    with index.updating() as entries:
+        removed = index.evict(entries, removed_files.append, None, 5)
+    assert removed == ['kept']
+    assert index.total_size == 0
@@ -0,0 +1,59 @@
+import asyncio
+
+from foxbuild import metrics
+from foxbuild.gauges import register_gauges
+
+
+async def request(port: int, data: bytes) -> bytes:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    await writer.drain()
+    res = await reader.read()
+    writer.close()
+    return res
+
+
+def test_server_serves_gauges():
+    register_gauges()
+    register_gauges()
+
+    async def main():
+        scrapes = []
+
+        async def on_scrape():
+            scrapes.append(1)
+
+        server = await metrics.start_server('127.0.0.1', 0, on_scrape)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            res = await request(port, b'GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n')
+            missing = await request(port, b'GET / HTTP/1.1\r\n\r\n')
+        finally:
+            server.close()
+            await server.wait_closed()
+        return res, missing, scrapes
+
+    res, missing, scrapes = asyncio.run(main())
+    assert res.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert res.count(b'# TYPE foxbuild_stages_running gauge\n') == 1
+    assert b'\nfoxbuild_stages_waiting 0\n' in res
+    assert missing.startswith(b'HTTP/1.1 404 ')
+    assert scrapes == [1]
+
+
+def test_server_drops_slow_clients(monkeypatch):
+    monkeypatch.setattr(metrics, 'REQUEST_READ_TIMEOUT', 0.2)
+
+    async def main():
+        server = await metrics.start_server('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            # never finishes its headers
+            return await asyncio.wait_for(
+                request(port, b'GET /metrics HTTP/1.1\r\nHost: x\r\n'), 5
+            )
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    assert asyncio.run(main()) == b''
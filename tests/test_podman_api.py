@@ -0,0 +1,171 @@
+import asyncio
+import json
+from subprocess import PIPE
+from urllib.parse import urlsplit
+
+import pytest
+
+from foxbuild import podman_api
+from foxbuild.podman_api import ApiSandbox
+from foxbuild.sandbox import Sandbox
+
+API_PREFIX = '/v4.0.0/libpod'
+
+
+def frame(stream: int, data: bytes) -> bytes:
+    return bytes([stream, 0, 0, 0]) + len(data).to_bytes(4, 'big') + data
+
+
+class FakeLibpod:
+    # Canned libpod responses over a unix socket, keeps the requests it got
+    def __init__(self):
+        self.requests: list[tuple[str, str, dict | None]] = []
+        self.execs: dict[str, dict] = {}
+        self.exec_polls: dict[str, int] = {}
+        self.containers: dict[str, dict] = {}
+
+    def specs(self, method: str, path: str) -> list[dict | None]:
+        return [body for m, p, body in self.requests if (m, p) == (method, path)]
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while request_line := await reader.readline():
+            method, target, _ = request_line.decode().split(' ', 2)
+            headers = {}
+            while (line := await reader.readline()) != b'\r\n':
+                name, value = line.decode().split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            path = urlsplit(target).path.removeprefix(API_PREFIX)
+            self.requests.append((method, path, json.loads(body) if body else None))
+            await self.respond(method, path, body, writer)
+
+    async def respond(
+        self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter
+    ):
+        parts = path.strip('/').split('/')
+        if (method, path) == ('POST', '/containers/create'):
+            container_id = f'c{len(self.containers)}'
+            self.containers[container_id] = json.loads(body)
+            return await self.send_json(writer, 201, {'Id': container_id})
+        if method == 'POST' and parts[0] == 'containers' and parts[2] == 'exec':
+            exec_id = f'e{len(self.execs)}'
+            self.execs[exec_id] = json.loads(body)
+            return await self.send_json(writer, 201, {'Id': exec_id})
+        if method == 'POST' and parts[0] == 'exec' and parts[2] == 'start':
+            return await self.send_exec_output(writer, self.execs[parts[1]])
+        if method == 'GET' and parts[0] == 'exec' and parts[2] == 'json':
+            # reported as still running on the first poll
+            polls = self.exec_polls[parts[1]] = self.exec_polls.get(parts[1], 0) + 1
+            exit_code = 3 if self.execs[parts[1]]['Cmd'][-1] == 'fail' else 0
+            return await self.send_json(
+                writer, 200, {'Running': polls == 1, 'ExitCode': exit_code}
+            )
+        if method == 'POST' and parts[0] == 'containers' and parts[2] == 'wait':
+            return await self.send(writer, 200, b'0')
+        return await self.send(writer, 204, b'')
+
+    async def send(self, writer: asyncio.StreamWriter, status: int, data: bytes):
+        writer.write(
+            f'HTTP/1.1 {status} X\r\nContent-Length: {len(data)}\r\n\r\n'.encode()
+            + data
+        )
+        await writer.drain()
+
+    async def send_json(self, writer: asyncio.StreamWriter, status: int, data):
+        await self.send(writer, status, json.dumps(data).encode())
+
+    async def send_exec_output(self, writer: asyncio.StreamWriter, exec_body: dict):
+        writer.write(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: application/vnd.docker.raw-stream\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n'
+        )
+        if exec_body['Cmd'][-1] == 'fail':
+            stream = (
+                frame(1, b'hello\n')
+                + frame(2, b'oops\n')
+                + frame(1, b'')
+                + frame(1, b'bye\n')
+            )
+            # chunk boundaries fall inside the frame headers and payloads
+            pieces = [stream[:3], stream[3:11], stream[11:20], stream[20:]]
+        else:
+            pieces = []
+        for piece in pieces:
+            writer.write(f'{len(piece):x}\r\n'.encode() + piece + b'\r\n')
+            await writer.drain()
+            await asyncio.sleep(0.01)
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+@pytest.fixture
+def fake_libpod(tmp_path, monkeypatch):
+    monkeypatch.setattr(Sandbox, 'PODMAN_SOCKET', str(tmp_path / 'podman.sock'))
+    return FakeLibpod()
+
+
+def run_with_server(fake_libpod: FakeLibpod, coro_fn):
+    async def main():
+        server = await asyncio.start_unix_server(
+            fake_libpod.handle, Sandbox.PODMAN_SOCKET
+        )
+        try:
+            await coro_fn()
+        finally:
+            await podman_api.close_client()
+            server.close()
+
+    asyncio.run(main())
+
+
+def test_session_exec(fake_libpod: FakeLibpod):
+    async def main():
+        sandbox = ApiSandbox(workdir='/workdir')
+        await sandbox.start_session()
+        assert fake_libpod.specs('POST', '/containers/c0/start') == [None]
+        spec = fake_libpod.containers['c0']
+        assert spec['name'] == sandbox.session
+        assert spec['remove'] is True
+        assert spec['work_dir'] == '/workdir'
+        assert spec['labels'] == {'foxbuild.sandbox': sandbox.id}
+
+        p = await sandbox.exec(
+            'sh', '-c', 'fail', env={'FOO': 'bar'}, stdout=PIPE, stderr=PIPE
+        )
+        stdout, stderr = await asyncio.gather(p.stdout.read(), p.stderr.read())
+        assert stdout == b'hello\nbye\n'
+        assert stderr == b'oops\n'
+        assert await p.wait() == 3
+
+        exec_body = fake_libpod.execs['e1']
+        assert exec_body['Cmd'][0] == 'capsh'
+        assert exec_body['Cmd'][-3:] == ['sh', '-c', 'fail']
+        assert 'FOO=bar' in exec_body['Env']
+        assert exec_body['WorkingDir'] == '/workdir'
+        # env of the previous command isn't kept
+        assert 'FOO' not in sandbox._env
+
+        session = sandbox.session
+        await sandbox.cleanup()
+        assert fake_libpod.specs('DELETE', f'/containers/{session}') == [None]
+
+    run_with_server(fake_libpod, main)
+
+
+def test_oneoff_is_removed_after_wait(fake_libpod: FakeLibpod):
+    async def main():
+        sandbox = ApiSandbox()
+        sandbox.unsafe_run_as_root = True
+        await sandbox._run_oneoff('true')
+        assert fake_libpod.containers['c0']['remove'] is False
+        paths = [(m, p) for m, p, _ in fake_libpod.requests]
+        assert paths == [
+            ('POST', '/containers/create'),
+            ('POST', '/containers/c0/start'),
+            ('POST', '/containers/c0/wait'),
+            ('DELETE', '/containers/c0'),
+        ]
+        await sandbox.cleanup()
+
+    run_with_server(fake_libpod, main)
@@ -0,0 +1,40 @@
+import asyncio
+import json
+import os
+
+from foxbuild.config import config
+from foxbuild.runner.profiles import ProfileStore
+
+
+def write_profile(store: ProfileStore, name: str, env: dict[str, str]):
+    store.rc_file(name).write_text(json.dumps(env))
+
+
+def test_processes_share_the_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'profile_store_max_count', 2)
+    a = ProfileStore(tmp_path)
+    b = ProfileStore(tmp_path)
+    for store, name in ((a, 'one'), (b, 'two')):
+        write_profile(store, name, {'NAME': name})
+        asyncio.run(store.add(name))
+    assert set(a.index.entries) == {'one', 'two'}
+    assert b.read('one') == {'NAME': 'one'}
+
+    # two was used less recently than one
+    write_profile(a, 'three', {'NAME': 'three'})
+    asyncio.run(a.add('three'))
+    assert set(b.index.entries) == {'one', 'three'}
+    assert b.read('two') is None
+    assert not b.rc_file('two').exists()
+
+
+def test_untracked_profiles_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'profile_store_max_count', 1)
+    store = ProfileStore(tmp_path)
+    write_profile(store, 'old', {})
+    os.utime(store.rc_file('old'), (0, 0))
+    write_profile(store, 'new', {})
+    store._add_untracked()
+    store.evict()
+    assert set(store.index.entries) == {'new'}
+    assert not store.rc_file('old').exists()
@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from foxbuild import web
+from foxbuild.config import config
+
+APP_ID = 1234
+
+
+class FakeInstallationClient:
+    def __init__(self):
+        self.posts: list[tuple[str, dict]] = []
+
+    async def post(self, url: str, json: dict):
+        self.posts.append((url, json))
+        return SimpleNamespace(raise_for_status=lambda: None)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    res = FakeInstallationClient()
+    monkeypatch.setattr(web.github, 'installation', lambda _: res)
+    monkeypatch.setattr(config, 'gh_app_id', APP_ID)
+    return res
+
+
+def make_job(event: str, action: str) -> SimpleNamespace:
+    payload = {
+        'action': action,
+        'installation': {'id': 1},
+        'repository': {'full_name': 'owner/repo'},
+    }
+    if event == 'check_suite':
+        payload['check_suite'] = {'head_sha': 'abc', 'head_branch': 'main'}
+    else:
+        payload['check_run'] = {'head_sha': 'abc', 'app': {'id': APP_ID}}
+    return SimpleNamespace(payload={'event': event, 'payload': payload})
+
+
+@pytest.mark.parametrize(
+    'event,action,rerun',
+    [
+        ('check_suite', 'requested', False),
+        ('check_suite', 'rerequested', True),
+        ('check_run', 'rerequested', True),
+    ],
+)
+def test_reruns_are_marked(client, event, action, rerun):
+    asyncio.run(web.handle_github_event(make_job(event, action)))
+    [(url, body)] = client.posts
+    assert url == '/repos/owner/repo/check-runs'
+    assert body['head_sha'] == 'abc'
+    assert (body.get('external_id') == web.RERUN_EXTERNAL_ID) == rerun
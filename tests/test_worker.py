@@ -0,0 +1,17 @@
+import asyncio
+
+import pytest
+
+from foxbuild.config import config
+from foxbuild.exceptions import ConfigurationError
+from foxbuild.worker import Worker
+
+
+@pytest.mark.parametrize('cpus,memory', [(None, 1 << 30), (2, None)])
+def test_worker_needs_its_share_of_the_host(monkeypatch, cpus, memory):
+    monkeypatch.setattr(config, 'coordinator_url', 'http://coordinator')
+    monkeypatch.setattr(config, 'worker_token', 'meow')
+    monkeypatch.setattr(config, 'host_cpus', cpus)
+    monkeypatch.setattr(config, 'host_memory', memory)
+    with pytest.raises(ConfigurationError, match='host_cpus and host_memory'):
+        asyncio.run(Worker().run())
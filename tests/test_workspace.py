@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from foxbuild.runner import workspace
+from foxbuild.runner.workspace import ensure_base, get_base_dir
+from foxbuild.schemas import StandaloneRunInfo
+
+
+def make_run_info(run_id: str) -> StandaloneRunInfo:
+    return StandaloneRunInfo(
+        provider='test',
+        run_id=run_id,
+        repo_name='owner/repo',
+        clone_url='https://example.com/owner/repo.git',
+        commit_sha='0' * 40,
+    )
+
+
+class FakeCheckout:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.calls = 0
+
+    async def __call__(self, run_info: StandaloneRunInfo, at):
+        self.calls += 1
+        (at / 'file').write_text('partial')
+        await asyncio.sleep(0.1)
+        if self.fail:
+            raise ValueError
+        (at / 'other').write_text('done')
+
+
+def test_concurrent_callers_check_out_once(monkeypatch):
+    checkout = FakeCheckout()
+    monkeypatch.setattr(workspace, 'checkout_commit', checkout)
+    run_info = make_run_info('concurrent')
+
+    async def main():
+        await asyncio.gather(*(ensure_base(run_info) for _ in range(3)))
+
+    asyncio.run(main())
+    assert checkout.calls == 1
+    assert (get_base_dir(run_info) / 'other').read_text() == 'done'
+
+
+def test_failed_checkout_leaves_no_base(monkeypatch):
+    checkout = FakeCheckout(fail=True)
+    monkeypatch.setattr(workspace, 'checkout_commit', checkout)
+    run_info = make_run_info('failing')
+    base_dir = get_base_dir(run_info)
+
+    with pytest.raises(ValueError):
+        asyncio.run(ensure_base(run_info))
+    assert not base_dir.exists()
+    assert not base_dir.with_name('base.tmp').exists()
+
+    checkout.fail = False
+    asyncio.run(ensure_base(run_info))
+    assert checkout.calls == 2
+    assert (base_dir / 'other').read_text() == 'done'